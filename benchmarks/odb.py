@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+Compare the GitPython object database backends selectable using the
+odbBackend option: commit lookup and rev walk latency, and memory. Each
+backend runs in a separate process on a generated repository.
+
+Usage: python benchmarks/odb.py [commits] [lookups]
+'''
+
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import git
+
+BACKENDS = {'python': git.GitDB, 'cmd': git.GitCmdObjectDB}
+
+
+def make_repo(path, commits, files=200):
+    ''' Create a packed repo with commits, each changing one of files. '''
+    git.Git().init('-q', path)
+    stream = []
+    for i in range(commits):
+        message = 'Commit %d\n\nChanging file %d.\n' % (i, i % files)
+        data = ('line %d\n' % i) * (1 + i % 50)
+        stream.append('commit refs/heads/master')
+        stream.append('committer Bench <bench@example> %d +0000' %
+                      (1000000000 + i))
+        stream.append('data %d' % len(message))
+        stream.append(message)
+        stream.append('M 644 inline file%d' % (i % files))
+        stream.append('data %d' % len(data))
+        stream.append(data)
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                            stdin=subprocess.PIPE)
+    proc.communicate('\n'.join(stream) + '\n')
+    subprocess.check_call(['git', 'repack', '-a', '-d', '-q'], cwd=path)
+
+
+def run(backend, path, lookups):
+    ''' Measure one backend, print results as a line of numbers. '''
+    repo = git.Repo(path, odbt=BACKENDS[backend])
+    shas = repo.git.rev_list('master').split()
+    random.seed(1)
+    sample = [random.choice(shas) for i in range(lookups)]
+    start = time.time()
+    for sha in sample:
+        commit = repo.commit(sha)
+        commit.message, commit.author.name
+    lookup = (time.time() - start) / lookups * 1000
+    start = time.time()
+    for commit in repo.iter_commits('master'):
+        commit.message, commit.author.name
+    walk = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print '%.3f %.2f %.1f' % (lookup, walk, rss)
+
+
+def main():
+    if sys.argv[1:2] == ['--run']:
+        run(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'repo')
+        make_repo(path, commits)
+        print '%d commits, %d random lookups' % (commits, lookups)
+        print '%-8s %12s %12s %12s' % ('backend', 'lookup ms', 'walk s',
+                                       'max RSS MB')
+        for backend in sorted(BACKENDS):
+            output = subprocess.check_output(
+                [sys.executable, __file__, '--run', backend, path,
+                 str(lookups)])
+            print '%-8s %12s %12s %12s' % tuple([backend] + output.split())
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
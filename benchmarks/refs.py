@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+Compare the cost of a no-op fetch from a remote with many refs, done the
+way the plugin used to (remote update plus one fetch per watched branch,
+protocol v0) and the way it does now (one fetch of the refs below the
+watched patterns' prefixes, protocol v2).
+
+Usage: python benchmarks/refs.py [number of refs] [rounds]
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+WATCHED = ['master', 'release-1', 'release-2']
+PREFIXES = ['master', 'release']
+
+
+def git(cwd, *args, **kwargs):
+    ''' Run git in cwd, return stdout. '''
+    proc = subprocess.Popen(('git',) + args, cwd=cwd,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate(kwargs.get('input'))
+    if proc.returncode != 0:
+        raise RuntimeError('git %s: %s' % (' '.join(args), err))
+    return out
+
+
+def make_upstream(path, count):
+    ''' Create repo with the watched branches and count other refs. '''
+    git(None, 'init', '-q', '-b', 'master', path)
+    git(path, '-c', 'user.name=bench', '-c', 'user.email=bench@example',
+        'commit', '-q', '--allow-empty', '-m', 'Initial')
+    sha = git(path, 'rev-parse', 'HEAD').strip().decode()
+    lines = ['create refs/heads/%s %s' % (b, sha) for b in WATCHED[1:]]
+    kinds = ['refs/pull/%d/head', 'refs/tags/v%d', 'refs/heads/ci-%d']
+    lines.extend([kinds[i % 3] % i + ' ' + sha for i in range(count)])
+    lines = [l if l.startswith('create') else 'create ' + l for l in lines]
+    git(path, 'update-ref', '--stdin',
+        input=('\n'.join(lines) + '\n').encode())
+    git(path, 'pack-refs', '--all')
+
+
+def old_fetch(clone):
+    ''' Fetch like the plugin used to. '''
+    git(clone, '-c', 'protocol.version=0', 'remote', 'update')
+    for branch in WATCHED:
+        git(clone, '-c', 'protocol.version=0', 'fetch', '--update-head-ok',
+            'origin', '%s:%s' % (branch, branch))
+
+
+def new_fetch(clone):
+    ''' Fetch like the plugin does now. '''
+    refspecs = ['+refs/heads/%s*:refs/remotes/origin/%s*' % (p, p)
+                for p in PREFIXES]
+    git(clone, '-c', 'protocol.version=2', 'fetch', '--prune', '--no-tags',
+        '--quiet', 'origin', *refspecs)
+    git(clone, 'fetch', '--update-head-ok', '--quiet', '.',
+        *['refs/remotes/origin/%s:refs/heads/%s' % (b, b) for b in WATCHED])
+
+
+def bench(func, clone, rounds):
+    ''' Return best time of rounds calls to func(clone). '''
+    func(clone)
+    times = []
+    for i in range(rounds):
+        start = time.time()
+        func(clone)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    tmp = tempfile.mkdtemp()
+    try:
+        upstream = os.path.join(tmp, 'upstream')
+        make_upstream(upstream, count)
+        url = 'file://' + upstream
+        for name, func in [('old', old_fetch), ('new', new_fetch)]:
+            clone = os.path.join(tmp, name)
+            git(None, 'clone', '-q', '--no-checkout', url, clone)
+            best = bench(func, clone, rounds)
+            print('%s: %.3f s per no-op fetch, best of %d, %d refs' %
+                  (name, best, rounds, count))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -72,31 +72,132 @@ _GROUP_HDR_TXT = """A boolean setting. If true, the commits for
  5 commits to our-game". A line like "Talking about fa1afe1?" is displayed
  before presenting data for a commit id found in the irc conversation."""
 
+_ANNOUNCE_BRANCHES_TXT = """A boolean setting. If true, a line is displayed
+ when a branch matching the branches option is created or deleted in the
+ remote repository. New branches are always tracked, this only controls
+ the announcement."""
+
+_CATALOG_TXT = """A boolean setting. If true, summaries of all commits on
+ watched branches are stored in an SQLite database in the local clone,
+ which is used to answer snarf and repolog requests without reading git
+ objects. The database is filled when enabled and updated by each poll."""
+
+_TRACK_TAGS_TXT = """A boolean setting. If true, tags are fetched and
+ created, moved and deleted tags are announced in the channel(s) using
+ tagMessage."""
+
+_TAG_MSG_TXT = """Message announcing a created or moved tag. Constructed
+ from printf-style substitutions, %t is the tag, %k created or moved. %m,
+ %a and %e describe the annotated tag, else the tagged commit. See
+ https://github.com/leamas/supybot-git for details."""
+
+_ODB_BACKEND_TXT = """How git objects are read by GitPython: python reads
+ pack files in-process, cmd uses a persistent git cat-file process. Which
+ is faster depends on the repository, benchmarks/odb.py compares them."""
+
+_PATHS_TXT = """Space-separated list of paths in the repository, as git
+ pathspecs. If not empty, only commits changing something below any of them
+ are announced. May be set per channel."""
+
+_AUTHORS_TXT = """Space-separated list of author names or email addresses.
+ If not empty, only commits by authors whose name or address contains any of
+ them, ignoring case, are announced. May be set per channel."""
+
 _TIMEOUT_TXT = """Max time for fetch operations (seconds). A value of 0
 disables timeout for this repo completely"""
 
 
+_listeners = []
+
+
+def add_listener(callback):
+    '''
+    Register callback(reponame, option) to be invoked when a registered
+    repository option changes value.
+    '''
+    if callback not in _listeners:
+        _listeners.append(callback)
+
+
+def remove_listener(callback):
+    ''' Unregister a callback added using add_listener(). '''
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+
+def _notifying(cls):
+    ''' Return a subclass of registry class cls notifying listeners. '''
+
+    class Notifying(cls):
+        # pylint: disable=W0232,R0903
+        __doc__ = cls.__doc__
+
+        def setValue(self, v):
+            old = self.__dict__.get('value')
+            cls.setValue(self, v)
+            if self._name == 'unset' or self.value == old:
+                return
+            # Name is supybot.plugins.Git.repos.<repo>.<option>
+            reponame, option = self._name.split('.')[-2:]
+            for callback in list(_listeners):
+                callback(reponame, option)
+
+    Notifying.__name__ = cls.__name__
+    return Notifying
+
+
+class _Backend(registry.OnlySomeStrings):
+    """Value must be python or cmd."""
+    validStrings = ('python', 'cmd')
+
+
+_String = _notifying(registry.String)
+_Boolean = _notifying(registry.Boolean)
+_Integer = _notifying(registry.Integer)
+_SpaceSeparatedListOfStrings = \
+    _notifying(registry.SpaceSeparatedListOfStrings)
+_Backend = _notifying(_Backend)
+
+
 _REPO_OPTIONS = {
     'url':
-        lambda: registry.String('', _URL_TEXT),
+        lambda: _String('', _URL_TEXT),
     'channels':
-        lambda: registry.SpaceSeparatedListOfStrings('', _CHANNELS_TXT),
+        lambda: _SpaceSeparatedListOfStrings('', _CHANNELS_TXT),
     'branches':
-        lambda: registry.String('*', _BRANCHES_TXT),
+        lambda: _String('*', _BRANCHES_TXT),
     'commitMessage1':
-        lambda: registry.String('[%n|%b|%a] %m', _MESSAGE1_TXT),
+        lambda: _String('[%n|%b|%a] %m', _MESSAGE1_TXT),
     'commitMessage2':
-        lambda: registry.String('', _MESSAGE2_TXT),
+        lambda: _String('', _MESSAGE2_TXT),
     'snarfMessage1':
-        lambda: registry.String('I. e., [%n|%a] %m', _SNARFMSG1_TXT),
+        lambda: _String('I. e., [%n|%a] %m', _SNARFMSG1_TXT),
     'snarfMessage2':
-        lambda: registry.String('', _SNARFMSG2_TXT),
+        lambda: _String('', _SNARFMSG2_TXT),
     'enableSnarf':
-        lambda: registry.Boolean(True, _SNARF_TXT),
+        lambda: _Boolean(True, _SNARF_TXT),
     'groupHeader':
-        lambda: registry.Boolean(True, _GROUP_HDR_TXT),
+        lambda: _Boolean(True, _GROUP_HDR_TXT),
+    'announceBranches':
+        lambda: _Boolean(False, _ANNOUNCE_BRANCHES_TXT),
     'fetchTimeout':
-        lambda: registry.Integer(60, _TIMEOUT_TXT),
+        lambda: _Integer(60, _TIMEOUT_TXT),
+    'commitCatalog':
+        lambda: _Boolean(False, _CATALOG_TXT),
+    'trackTags':
+        lambda: _Boolean(False, _TRACK_TAGS_TXT),
+    'tagMessage':
+        lambda: _String('Tag %t %k at %n: %m', _TAG_MSG_TXT),
+    'odbBackend':
+        lambda: _Backend('python', _ODB_BACKEND_TXT),
+}
+
+# Repository options which may have channel-specific values.
+_CHANNEL_OPTIONS = {
+    'paths':
+        lambda: registry.SpaceSeparatedListOfStrings([], _PATHS_TXT),
+    'authors':
+        lambda: registry.SpaceSeparatedListOfStrings([], _AUTHORS_TXT),
 }
 
 
@@ -115,10 +216,19 @@ def repo_option(reponame, option):
     try:
         return repo.get(option)
     except registry.NonExistentRegistryEntry:
-        conf.registerGlobalValue(repo, option, _REPO_OPTIONS[option]())
+        if option in _CHANNEL_OPTIONS:
+            conf.registerChannelValue(repo, option,
+                                      _CHANNEL_OPTIONS[option]())
+        else:
+            conf.registerGlobalValue(repo, option, _REPO_OPTIONS[option]())
         return repo.get(option)
 
 
+def channel_option(reponame, option, channel):
+    ''' Return value of a repo-specific option in a given channel. '''
+    return repo_option(reponame, option).get(channel).value
+
+
 def unregister_repo(reponame):
     ''' Unregister  repository from registry. '''
     try:
@@ -154,15 +264,82 @@ conf.registerGlobalValue(Git, 'repoDir',
 
 conf.registerGlobalValue(Git, 'pollPeriod',
     registry.NonNegativeInteger(120, """ How often (in seconds) that
-  repositories will be polled for changes. Zero disables periodic polling.
-  If you change the value from zero to a positive value, call `rehash` to
-  restart polling."""))
+  repositories will be polled for changes initially. The interval is then
+  adapted to how often each repository changes, within minPollPeriod and
+  maxPollPeriod. Zero disables periodic polling. If you change the value
+  from zero to a positive value, call `rehash` to restart polling."""))
+
+conf.registerGlobalValue(Git, 'minPollPeriod',
+    registry.PositiveInteger(30, """ Shortest time (in seconds) between
+  fetches of a repository. Repositories which are changed often are fetched
+  more frequently, down to this limit."""))
+
+conf.registerGlobalValue(Git, 'maxPollPeriod',
+    registry.NonNegativeInteger(900, """ Longest time (in seconds) between
+  fetches of a repository. Repositories which aren't changed are fetched
+  less frequently, up to this limit."""))
 
 conf.registerGlobalValue(Git, 'maxCommitsAtOnce',
     registry.NonNegativeInteger(5, """Limit how many commits can be displayed
   in one update. This will affect output from the periodic polling as well
   as the log command"""))
 
+conf.registerGlobalValue(Git, 'catchUpThreshold',
+    registry.NonNegativeInteger(50, """If more commits than this arrived in
+  a repository since last poll, e. g. after the bot was disconnected, a
+  digest is shown instead: for each branch, the number of commits by each
+  author and the first and last commit. Zero disables."""))
+
+conf.registerGlobalValue(Git, 'snarfDedupWindow',
+    registry.NonNegativeInteger(600, """Time (in seconds) during which a
+  commit already reported in a channel because its id was mentioned is not
+  reported again. Zero disables."""))
+
+conf.registerGlobalValue(Git, 'maxOpenRepos',
+    registry.PositiveInteger(32, """Max number of repositories kept open
+  at the same time. Least recently used repositories are closed when the
+  limit is reached, and reopened when needed. Each open repository uses
+  memory and file descriptors for caches and helper processes."""))
+
+conf.registerGlobalValue(Git, 'cloneWorkers',
+    registry.PositiveInteger(4, """Max number of clones running at the same
+  time when adding repositories using repoadd or repoimport. Takes effect
+  after reload."""))
+
+conf.registerGlobalValue(Git, 'maintenancePeriod',
+    registry.NonNegativeInteger(86400, """How often (in seconds) each
+  repository clone is maintained: the commit-graph is updated, loose objects
+  are packed and old unreachable objects pruned. This runs in the background
+  at low priority and never at the same time as a fetch of the same
+  repository. Polls are only blocked while the commit-graph is written.
+  Zero disables."""))
+
+conf.registerGlobalValue(Git, 'memorySampleRate',
+    registry.Probability(0.0, """Fraction of the fetch/poll cycles which
+  are sampled for memory growth diagnostics shown by gitmem, 0.0 - 1.0.
+  Sampling counts the objects known to the gc by type, which is slow on
+  big processes. A low value like 0.01 is cheap enough to be left on."""))
+
+conf.registerGlobalValue(Git, 'traceFile',
+    registry.String('', """File where traced fetch/poll cycles are written
+  as JSON lines, one for each timed span: cycle, repo fetch, ref update,
+  diffstat, lock wait, queue, rev count, rev walk and render. The file is
+  rotated at 10 MB. Relative paths are interpreted from supybot's startup
+  directory. Empty disables tracing."""))
+
+conf.registerGlobalValue(Git, 'traceSampleRate',
+    registry.Probability(1.0, """Fraction of the fetch/poll cycles which
+  are traced when traceFile is set, 0.0 - 1.0. Lower it to reduce overhead
+  on busy bots."""))
+
+conf.registerGlobalValue(Git, 'sharedMode',
+    registry.Boolean(False, """A boolean setting. If true, the clones in
+  repoDir may be shared with other bots on the same host using the same
+  repoDir. For each repository, one bot fetches and publishes the new
+  branch tips; the others only read them. Existing clones are reused by
+  repoadd and not deleted by repokill. All bots should watch the same
+  branches. Takes effect after reload."""))
+
 conf.registerGlobalValue(Git, 'fetchTimeout',
     registry.NonNegativeInteger(300, """Max time for fetch operations
        (seconds)."""))
@@ -49,12 +49,30 @@ See: The supybot docs, notably ADVANCED_PLUGIN_CONFIG.rst and
      ADVANCED_PLUGIN_TESTING.rst.
 """
 
+import collections
+import contextlib
+import distutils.spawn
 import fnmatch
+import gc
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
 import os
+import Queue
+import random
+import re
+import resource
 import shutil
+import sqlite3
+import sys
+import types
+import urlparse
 
 from supybot import callbacks
 from supybot import ircmsgs
+from supybot import ircutils
 from supybot import log
 from supybot import schedule
 from supybot import world
@@ -65,6 +83,11 @@ from supybot.commands import time
 from supybot.commands import wrap
 from supybot.utils.str import nItems
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import config
 
 try:
@@ -83,30 +106,376 @@ class GitPluginException(Exception):
     pass
 
 
-def _format_message(ctx, commit, branch='unknown'):
+class _CommitSummary(object):
+    '''
+    The commit data needed for display, without any git objects. parents
+    is a tuple of parent shas, empty if unknown. branches lists watched
+    branches which the commit newly reached in a poll, else None.
+    '''
+    __slots__ = ('hexsha', 'author_name', 'author_email',
+                 'committed_date', 'subject', 'parents', 'branches')
+
+    def __init__(self, hexsha, author_name, author_email, committed_date,
+                 subject, parents=()):
+        self.hexsha = hexsha
+        self.author_name = author_name
+        self.author_email = author_email
+        self.committed_date = committed_date
+        self.subject = subject
+        self.parents = parents
+        self.branches = None
+
+
+# Fields separated by \x01, records by NUL (git log -z).
+_LOG_FORMAT = '%H%x01%P%x01%an%x01%ae%x01%ct%x01%B'
+
+
+def _iter_log(repo, *args):
+    '''
+    Run git log with given revision arguments and yield a
+    (_CommitSummary, full message) tuple for each commit. Output is
+    streamed, large histories are never held in memory.
+    '''
+    proc = repo.git.log('-z', '--format=' + _LOG_FORMAT, *args,
+                        as_process=True)
+    buf = ''
+    while True:
+        chunk = proc.stdout.read(65536)
+        if not chunk:
+            break
+        records = (buf + chunk).split('\0')
+        buf = records.pop()
+        for record in records:
+            yield _parse_log_record(record)
+    if buf.strip():
+        yield _parse_log_record(buf)
+    proc.wait()
+
+
+def _parse_log_record(record):
+    ''' Parse a _LOG_FORMAT record into (_CommitSummary, message). '''
+    sha, parents, name, email, date, message = \
+        record.decode('utf-8', 'replace').split('\x01', 5)
+    summary = _CommitSummary(sha.strip(), name, email, int(date),
+                             message.split('\n')[0],
+                             tuple(parents.split()))
+    return summary, message
+
+
+# Matches formats using the %f, %+ or %- diffstat substitutions.
+_DIFFSTAT_RE = re.compile(r'(?<!%)(?:%%)*%[-+f]')
+
+
+def _numstat(repo, *args):
+    '''
+    Run git log --numstat with given arguments, return dict of sha ->
+    (files changed, lines added, lines removed). Binary files are only
+    counted as changed, merges have no stats.
+    '''
+    output = repo.git.log('--format=%x00%H', '--numstat', *args)
+    stats = {}
+    for record in output.split('\0')[1:]:
+        lines = record.strip('\n').split('\n')
+        files = added = removed = 0
+        for line in lines[1:]:
+            if not line:
+                continue
+            plus, minus = line.split('\t', 2)[0:2]
+            files += 1
+            added += int(plus) if plus.isdigit() else 0
+            removed += int(minus) if minus.isdigit() else 0
+        stats[lines[0]] = (files, added, removed)
+    return stats
+
+
+_WORD_RE = re.compile(r'\w+(?:[-.]\w+)*', re.UNICODE)
+
+
+def _tokenize(text):
+    '''
+    Return set of lowercase search terms in text. Compound words like
+    BUG-1234 or v1.2 are indexed both whole and as their parts.
+    '''
+    terms = set()
+    for word in _WORD_RE.findall(text.lower()):
+        terms.add(word)
+        if '-' in word or '.' in word:
+            terms.update(re.split(r'[-.]', word))
+    return terms
+
+
+def _author_terms(name, email):
+    ''' Return set of author index terms, 'a:' + name part or email. '''
+    return set(['a:' + t for t in _tokenize(name)] + ['a:' + email.lower()])
+
+
+def _parse_date(value):
+    '''
+    Parse a search date: Nd, Nw (N days/weeks ago) or YYYY-MM-DD.
+    Returns seconds since epoch, throws ValueError.
+    '''
+    match = re.match(r'^(\d+)([dw])$', value)
+    if match:
+        days = int(match.group(1)) * (7 if match.group(2) == 'w' else 1)
+        return int(time.time()) - days * 24 * 3600
+    return int(time.mktime(time.strptime(value, '%Y-%m-%d')))
+
+
+def _parse_search(text):
+    '''
+    Parse a gitsearch query into (terms, author terms, since, until).
+    Words are AND:ed, author:<name|email>, since:<date> and until:<date>
+    limits the results, see _parse_date(). Throws ValueError.
+    '''
+    terms = set()
+    authors = set()
+    since = None
+    until = None
+    for word in text.split():
+        key, sep, value = word.partition(':')
+        if sep and key == 'author' and value:
+            if '@' in value:
+                authors.add('a:' + value.lower())
+            else:
+                authors.update(['a:' + t for t in _tokenize(value)])
+        elif sep and key == 'since':
+            since = _parse_date(value)
+        elif sep and key == 'until':
+            until = _parse_date(value)
+        else:
+            terms.update(_tokenize(word))
+    if not terms and not authors and since is None and until is None:
+        raise ValueError('Nothing to search for')
+    return terms, authors, since, until
+
+
+class _CommitCatalog(object):
+    '''
+    Optional on-disk SQLite catalog of commit summaries and the watched
+    branches containing them, serving snarf and repolog without reading
+    git objects. A connection is opened for each operation since the
+    catalog is used from several threads.
+    '''
+
+    _SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS commits (
+               sha TEXT PRIMARY KEY, author TEXT, email TEXT,
+               date INTEGER, subject TEXT)''',
+        # pos orders commits in a branch as git log does, newest highest.
+        '''CREATE TABLE IF NOT EXISTS branches (
+               branch TEXT, pos INTEGER, sha TEXT,
+               PRIMARY KEY (branch, sha))''',
+        '''CREATE INDEX IF NOT EXISTS branches_pos
+               ON branches (branch, pos)''',
+        '''CREATE INDEX IF NOT EXISTS branches_sha ON branches (sha)''',
+        '''CREATE INDEX IF NOT EXISTS commits_date ON commits (date)''',
+        # Inverted index: message words and 'a:'-prefixed author terms.
+        '''CREATE TABLE IF NOT EXISTS terms (
+               term TEXT, sha TEXT, PRIMARY KEY (term, sha))''',
+    ]
+
+    # Bump to force a backfill of catalogs created by older code.
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.log = log.getPluginLogger('git.catalog')
+        with self._connect() as db:
+            for statement in self._SCHEMA:
+                db.execute(statement)
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+        self.outdated = version < self.VERSION
+
+    def set_current(self):
+        ''' Mark catalog as up to date after backfilling all branches. '''
+        with self._connect() as db:
+            db.execute('PRAGMA user_version = %d' % self.VERSION)
+        self.outdated = False
+
+    @contextlib.contextmanager
+    def _connect(self):
+        ''' Yield a connection, committing on success. '''
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, branch, commits):
+        '''
+        Add commits, a list of (_CommitSummary, message) newest first as
+        from git log, on top of what's already stored for branch.
+        '''
+        with self._connect() as db:
+            top = db.execute('SELECT MAX(pos) FROM branches WHERE branch = ?',
+                             (branch,)).fetchone()[0] or 0
+            self._insert(db, branch, top + len(commits), commits)
+
+    @staticmethod
+    def _insert(db, branch, pos, commits):
+        ''' Insert and index commits at descending positions from pos. '''
+        db.executemany(
+            'INSERT OR IGNORE INTO commits VALUES (?, ?, ?, ?, ?)',
+            [(c.hexsha, c.author_name, c.author_email, c.committed_date,
+              c.subject) for c, message in commits])
+        db.executemany(
+            'INSERT OR IGNORE INTO branches VALUES (?, ?, ?)',
+            [(branch, pos - i, c.hexsha)
+                for i, (c, message) in enumerate(commits)])
+        db.executemany(
+            'INSERT OR IGNORE INTO terms VALUES (?, ?)',
+            [(term, c.hexsha) for c, message in commits
+                 for term in _tokenize(message) |
+                     _author_terms(c.author_name, c.author_email)])
+
+    def backfill(self, repo, branch, batch=10000):
+        '''
+        Replace all data for branch with its complete history, inserted
+        in batches while streaming git log output.
+        '''
+        start = time.time()
+        with self._connect() as db:
+            db.execute('DELETE FROM branches WHERE branch = ?', (branch,))
+            pos = 0
+            commits = []
+            for item in _iter_log(repo, branch, '--'):
+                commits.append(item)
+                if len(commits) >= batch:
+                    self._insert(db, branch, pos, commits)
+                    pos -= len(commits)
+                    commits = []
+            self._insert(db, branch, pos, commits)
+        self.log.debug("Backfilled %s in %s: %.2fs" %
+                       (branch, self.path, time.time() - start))
+
+    def head(self, branch):
+        ''' Return sha of newest commit stored for branch, or None. '''
+        with self._connect() as db:
+            row = db.execute(
+                '''SELECT sha FROM branches WHERE branch = ?
+                       ORDER BY pos DESC LIMIT 1''', (branch,)).fetchone()
+        return row[0] if row else None
+
+    def drop_branch(self, branch):
+        ''' Forget which commits a branch contains. '''
+        with self._connect() as db:
+            db.execute('DELETE FROM branches WHERE branch = ?', (branch,))
+
+    @staticmethod
+    def _summary(row):
+        ''' Convert a commits table row to a _CommitSummary. '''
+        return _CommitSummary(*row)
+
+    def lookup(self, shas):
+        '''
+        Return dict sha -> _CommitSummary for the commits which have the
+        given shas as unambiguous prefixes, unknown ones are omitted.
+        '''
+        shas = [sha.lower() for sha in shas]
+        ranges = ' OR '.join(['(sha >= ? AND sha < ?)'] * len(shas))
+        params = []
+        for sha in shas:
+            params.extend([sha, sha + 'g'])
+        with self._connect() as db:
+            rows = db.execute('SELECT * FROM commits WHERE ' + ranges,
+                              params).fetchall()
+        found = {}
+        for sha in shas:
+            matches = [r for r in rows if r[0].startswith(sha)]
+            if len(matches) == 1:
+                found[sha] = self._summary(matches[0])
+        return found
+
+    def search(self, terms, authors, since, until, limit):
+        '''
+        Return (number of matches, list of (branch, _CommitSummary)) for
+        the at most limit newest commits matching all terms and author
+        terms, committed in [since, until]. See _parse_search().
+        '''
+        where = []
+        params = []
+        with self._connect() as db:
+            # Drive the query from the rarest term.
+            counts = [(db.execute('SELECT COUNT(*) FROM terms WHERE term = ?',
+                                  (t,)).fetchone()[0], t)
+                          for t in terms | authors]
+            counts.sort()
+            if counts and counts[0][0] == 0:
+                return 0, []
+            source = 'commits c'
+            if counts:
+                source = 'terms t JOIN commits c ON c.sha = t.sha'
+                where.append('t.term = ?')
+                params.append(counts[0][1])
+            for count, term in counts[1:]:
+                where.append('c.sha IN (SELECT sha FROM terms WHERE term = ?)')
+                params.append(term)
+            if since is not None:
+                where.append('c.date >= ?')
+                params.append(since)
+            if until is not None:
+                where.append('c.date <= ?')
+                params.append(until)
+            query = ' FROM %s WHERE %s' % (source, ' AND '.join(where))
+            total = db.execute('SELECT COUNT(*)' + query,
+                               params).fetchone()[0]
+            rows = db.execute('SELECT c.*' + query +
+                                  ' ORDER BY c.date DESC LIMIT ?',
+                              params + [limit]).fetchall()
+            result = []
+            for row in rows:
+                branch = db.execute(
+                    '''SELECT branch FROM branches WHERE sha = ?
+                           ORDER BY branch LIMIT 1''',
+                    (row[0],)).fetchone()
+                result.append((branch[0] if branch else 'unknown',
+                               self._summary(row)))
+        return total, result
+
+    def recent(self, branch, count):
+        ''' Return the count latest commits on branch, newest first. '''
+        with self._connect() as db:
+            rows = db.execute(
+                '''SELECT c.* FROM branches b JOIN commits c ON c.sha = b.sha
+                       WHERE b.branch = ? ORDER BY b.pos DESC LIMIT ?''',
+                (branch, count)).fetchall()
+        return [self._summary(r) for r in rows]
+
+
+def _format_message(ctx, commit, branch='unknown', tag=None):
     """
     Generate an formatted message for IRC from the given commit, using
-    the format specified in the config. Returns a list of strings.
+    the format specified in the config. Returns a list of strings. If
+    tag is a (name, 'created'|'moved') tuple, commit describes the tag
+    and the tag message format is used.
     """
     MODE_NORMAL = 0
     MODE_SUBST = 1
     MODE_COLOR = 2
     subst = {
-        'a': commit.author.name,
+        'a': commit.author_name,
         'b': branch,
         'c': commit.hexsha[0:7],
         'C': commit.hexsha,
-        'e': commit.author.email,
-        'm': commit.message.split('\n')[0],
+        'e': commit.author_email,
+        'k': tag[1] if tag else '',
+        'm': commit.subject,
         'n': ctx.repo.name,
+        't': tag[0] if tag else ' '.join(ctx.repo.tags_at(commit.hexsha)),
         'S': ' ',
         'u': ctx.repo.options.url,
         'r': '\x0f',
         '!': '\x02',
         '%': '%',
     }
+    fmt = ctx.repo.options.tag_msg if tag else ctx.format
+    if _DIFFSTAT_RE.search(fmt):
+        stats = ctx.repo.diffstats([commit.hexsha])
+        files, added, removed = stats.get(commit.hexsha, (0, 0, 0))
+        subst.update({'f': str(files), '+': str(added), '-': str(removed)})
     result = []
-    lines = ctx.format.split('\n')
+    lines = fmt.split('\n')
     for line in lines:
         mode = MODE_NORMAL
         outline = ''
@@ -135,51 +504,180 @@ def _format_message(ctx, commit, branch='unknown'):
     return result
 
 
-def _get_branches(option_val, repo):
-    ''' Return list of branches in repo matching users's option_val. '''
+# Max length of a line sent to the server, without CR-LF.
+_MAX_LINE = 510
+
+
+def _max_targets(irc):
+    '''
+    Return max number of targets in a PRIVMSG according to the server's
+    TARGMAX or MAXTARGETS, 1 if not advertised.
+    '''
+    supported = irc.state.supported
+    if 'targmax' in supported:
+        for item in (supported['targmax'] or '').split(','):
+            command, _, limit = item.partition(':')
+            if command.upper() == 'PRIVMSG':
+                return int(limit) if limit.isdigit() else sys.maxint
+        return 1
+    if 'maxtargets' in supported:
+        try:
+            return max(1, int(supported['maxtargets']))
+        except (TypeError, ValueError):
+            pass
+    return 1
+
+
+def _privmsgs(irc, channels, line):
+    '''
+    Return list of PRIVMSGs sending line to all channels, each message
+    having up to the server's max number of comma-separated targets which
+    fits in the line length limit.
+    '''
+
+    def privmsg(targets):
+        ''' ircmsgs.privmsg() in strict mode rejects target lists. '''
+        if len(targets) == 1:
+            return ircmsgs.privmsg(targets[0], line)
+        return ircmsgs.IrcMsg(command='PRIVMSG',
+                              args=(','.join(targets), line))
+
+    limit = _max_targets(irc)
+    room = _MAX_LINE - len('PRIVMSG  :') - len(line)
+    msgs = []
+    targets = []
+    for channel in channels:
+        if targets and (len(targets) >= limit or
+                        len(','.join(targets + [channel])) > room):
+            msgs.append(privmsg(targets))
+            targets = []
+        targets.append(channel)
+    if targets:
+        msgs.append(privmsg(targets))
+    return msgs
+
+
+class _BranchMatcher(object):
+    '''
+    The branches option compiled once into regular expressions, so
+    that single refs can be matched cheaply as they appear.
+    '''
+
+    def __init__(self, option_val):
+        self.patterns = [b.strip() for b in option_val.split()]
+        self._regexps = [re.compile(fnmatch.translate(p))
+                            for p in self.patterns]
+
+    def match(self, branch):
+        ''' Return True if branch matches any pattern. '''
+        return any(r.match(branch) for r in self._regexps)
+
+    def filter(self, branches):
+        ''' Return the branches matching any pattern. '''
+        return [b for b in branches if self.match(b)]
+
+    def prefixes(self):
+        '''
+        Return sorted list of branch name prefixes such that all branches
+        matching any pattern start with one of them. [''] means anything.
+        '''
+        prefixes = set([re.split(r'[*?[]', p)[0] for p in self.patterns])
+        return sorted([p for p in prefixes
+                       if not [q for q in prefixes
+                                   if q != p and p.startswith(q)]])
+
+    def refspecs(self):
+        ''' Return refspecs fetching the remote branches possibly matching. '''
+        return ['+refs/heads/%s*:refs/remotes/origin/%s*' % (p, p)
+                for p in self.prefixes()]
+
+
+_GIT_VERSION = []
+
+
+def _git_version():
+    ''' Return version tuple of the git command, e. g. (2, 39, 5). '''
+    if not _GIT_VERSION:
+        _GIT_VERSION.append(git.Git().version_info)
+    return _GIT_VERSION[0]
+
+
+def _get_branches(matcher, remote_heads):
+    '''
+    Return list of branches in remote_heads matching the _BranchMatcher,
+    logging patterns which don't match anything.
+    '''
     log_ = log.getPluginLogger('git.get_branches')
-    opt_branches = [b.strip() for b in option_val.split()]
-    repo.remote().update()
-    repo_branches = \
-        [r.name.split('/')[1] for r in repo.remote().refs if r.is_detached]
-    branches = []
-    for opt in opt_branches:
-        matched = fnmatch.filter(repo_branches, opt)
-        if not matched:
-            log_.warning("No branch in repository matches " + opt)
-        else:
-            branches.extend(matched)
+    branches = matcher.filter(remote_heads)
+    for pattern in matcher.patterns:
+        if not fnmatch.filter(branches, pattern):
+            log_.warning("No branch in repository matches " + pattern)
     if not branches:
-        log_.error("No branch in repository matches: " + option_val)
+        log_.error("No branch in repository matches: " +
+                   ' '.join(matcher.patterns))
     return branches
 
 
-def _poll_all_repos(repolist, throw = False):
-    '''Find and store new commits in repo.new_commits_by_branch. '''
+def _poll_all_repos(repos, repolist=None, throw = False):
+    '''
+    Find and display new commits in the repositories in repolist, by
+    default all in repos. Targets are looked up in the repos index.
+    '''
 
     def poll_repository(repository, targets):
         ''' Perform poll of a repo, determine changes. '''
-        with repository.lock:
-            new_commits_by_branch = repository.get_new_commits()
+        with _locked(repository):
+            events = repository.branch_events
+            repository.branch_events = []
+            if not repository.options.announce_branches:
+                events = []
+            tag_events = repository.tag_events
+            repository.tag_events = []
+            threshold = config.global_option('catchUpThreshold').value
+            digest = threshold and \
+                repository.count_new_commits() > threshold
+            if digest:
+                repository.skip_new_commits()
+            else:
+                new_commits_by_branch = repository.get_new_commits()
+            channels_by_key = collections.OrderedDict()
             for irc, channel in targets:
-                ctx = _DisplayCtx(irc, channel, repository)
-                ctx.display_commits(new_commits_by_branch)
-            for branch in new_commits_by_branch:
-                repository.commit_by_branch[branch] = \
-                   repository.get_commit(branch)
+                key = (irc, repository.filters(channel))
+                channels_by_key.setdefault(key, []).append(channel)
+            by_filters = {}
+            for irc, filters in channels_by_key:
+                if filters in by_filters:
+                    continue
+                if digest:
+                    by_filters[filters] = repository.get_digest(filters)
+                else:
+                    by_filters[filters] = repository.filter_new_commits(
+                        new_commits_by_branch, filters)
+            with _TRACER.span('render', targets=len(targets)):
+                for key, channels in channels_by_key.iteritems():
+                    irc, filters = key
+                    ctx = _DisplayCtx(irc, channels, repository)
+                    ctx.display_branch_events(events)
+                    ctx.display_tag_events(tag_events)
+                    if digest:
+                        ctx.display_digest(by_filters[filters])
+                    else:
+                        ctx.display_commits(by_filters[filters])
+            repository.commit_by_branch.update(repository.new_heads)
 
     start = time.time()
     _log = log.getPluginLogger('git.pollAllRepos')
+    if repolist is None:
+        repolist = repos.get()
     for repository in repolist:
-        # Find the IRC/channel pairs to notify
-        targets = []
-        for irc in world.ircs:
-            for channel in repository.options.channels:
-                if channel in irc.state.channels:
-                    targets.append((irc, channel))
+        targets = repos.targets(repository)
         if not targets:
             _log.info("Skipping %s: not in configured channel(s)." %
                           repository.name)
+            # Nobody to tell, don't let events pile up until joined.
+            with _locked(repository):
+                repository.branch_events = []
+                repository.tag_events = []
             continue
         try:
             poll_repository(repository, targets)
@@ -191,6 +689,530 @@ def _poll_all_repos(repolist, throw = False):
                    str(time.time() - start))
 
 
+class _RepoHandles(object):
+    '''
+    Bounded LRU pool of open GitPython Repo handles, shared by all
+    repositories. Handles are opened on demand; the least recently used
+    is evicted when the pool is full. Eviction stops the handle's
+    persistent git processes; a thread still using an evicted handle
+    transparently restarts them, and it's released when last used.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles = collections.OrderedDict()
+        self.hits = 0
+        self.opened = 0
+        self.evicted = 0
+
+    # odbBackend option value -> GitPython object database class.
+    BACKENDS = {'python': git.GitDB, 'cmd': git.GitCmdObjectDB}
+
+    def get(self, path, backend='python'):
+        '''
+        Return open Repo for path using given odbBackend, throws
+        git.exc.NoSuchPathError.
+        '''
+        with self._lock:
+            repo = self._handles.pop(path, None)
+            if repo:
+                self.hits += 1
+            else:
+                repo = git.Repo(path, odbt=self.BACKENDS[backend])
+                self.opened += 1
+            self._handles[path] = repo
+            size = max(1, config.global_option('maxOpenRepos').value)
+            while len(self._handles) > size:
+                self._close(self._handles.popitem(last=False)[1])
+            return repo
+
+    def discard(self, path):
+        ''' Close the handle for path, if open. '''
+        with self._lock:
+            repo = self._handles.pop(path, None)
+            if repo:
+                self._close(repo)
+
+    def _close(self, repo):
+        ''' Release resources held by repo, caller holds lock. '''
+        repo.git.clear_cache()
+        self.evicted += 1
+
+    def stats(self):
+        ''' Return dict of pool statistics. '''
+        with self._lock:
+            return {'open': len(self._handles),
+                    'size': config.global_option('maxOpenRepos').value,
+                    'hits': self.hits,
+                    'opened': self.opened,
+                    'evicted': self.evicted}
+
+
+_HANDLES = _RepoHandles()
+
+
+def _url_host(url):
+    ''' Return host part of a remote url, None for local paths. '''
+    if '://' in url:
+        return urlparse.urlparse(url).hostname
+    match = re.match(r'(?:[^@/]+@)?([^:/]{2,}):', url)      # scp-like
+    return match.group(1) if match else None
+
+
+class _Breaker(object):
+    '''
+    Circuit breaker for fetches from a repository or host. Closed lets
+    fetches through. After THRESHOLD consecutive failures it opens and
+    refuses fetches during a backoff time, doubled each time it reopens
+    up to MAX_BACKOFF. It's then half-open: a single probe fetch is let
+    through, closing it on success and reopening it on failure.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    THRESHOLD = 3
+    BACKOFF = 60
+    MAX_BACKOFF = 3600
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = 0
+        self.retry_at = 0
+        self.error = None
+
+    def ready(self, now):
+        ''' Return True if a fetch could be let through. '''
+        return self.state == self.CLOSED or \
+            (self.state == self.OPEN and now >= self.retry_at)
+
+    def allow(self, now):
+        ''' Let a fetch through if ready(), return False if not. '''
+        if not self.ready(now):
+            return False
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+        return True
+
+    def success(self):
+        ''' Record a successful fetch, return True if state changed. '''
+        changed = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = 0
+        self.error = None
+        return changed
+
+    def failure(self, error, now):
+        ''' Record a failed fetch, return True if breaker opened. '''
+        self.failures += 1
+        self.error = error
+        if self.state == self.OPEN or \
+                (self.state == self.CLOSED and
+                     self.failures < self.THRESHOLD):
+            return False
+        self.backoff = min(self.backoff * 2 or self.BACKOFF,
+                           self.MAX_BACKOFF)
+        self.retry_at = now + self.backoff
+        self.state = self.OPEN
+        return True
+
+    def describe(self, now):
+        ''' Return one-line state description. '''
+        text = '%s %s after %d failure(s)' % (
+            self.name, self.state, self.failures)
+        if self.state == self.OPEN:
+            text += ', retry in %d s' % max(0, self.retry_at - now)
+        return text
+
+
+class _Breakers(object):
+    '''
+    The circuit breakers for all repositories and their hosts. A fetch
+    is only let through if both the repository's and the host's breakers
+    allow it. State changes are logged, other failures are not.
+    '''
+
+    def __init__(self):
+        self.log = log.getPluginLogger('git.breaker')
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def _get(self, repository):
+        ''' Return list of breakers for repository, creating as needed. '''
+        names = ['repo ' + repository.name]
+        host = _url_host(repository.options.url)
+        if host:
+            names.append('host ' + host)
+        for name in names:
+            if name not in self._breakers:
+                self._breakers[name] = _Breaker(name)
+        return [self._breakers[name] for name in names]
+
+    def allow(self, repository):
+        '''
+        Return True if repository may be fetched now; an open breaker
+        which is due to be retried then becomes half-open.
+        '''
+        now = time.time()
+        with self._lock:
+            breakers = self._get(repository)
+            if not all([b.ready(now) for b in breakers]):
+                return False
+            for breaker in breakers:
+                breaker.allow(now)
+            return True
+
+    def retry_at(self, repository):
+        ''' Return time when repository could be allowed again. '''
+        with self._lock:
+            return max([b.retry_at for b in self._get(repository)])
+
+    def record(self, repository, error=None):
+        ''' Record outcome of a fetch, error is None on success. '''
+        now = time.time()
+        with self._lock:
+            for breaker in self._get(repository):
+                if error is None:
+                    if breaker.success():
+                        self.log.info("Fetching from %s works again" %
+                                      breaker.name)
+                elif breaker.failure(error, now):
+                    self.log.error("Fetching from %s failed %d times,"
+                                   " retry in %d s: %s" %
+                                   (breaker.name, breaker.failures,
+                                    breaker.backoff, error))
+                else:
+                    self.log.debug("Fetching from %s failed: %s" %
+                                   (breaker.name, error))
+
+    def troubles(self, repository=None):
+        '''
+        Return descriptions of breakers not closed or with failures, for
+        repository if given else all of them.
+        '''
+        now = time.time()
+        with self._lock:
+            if repository:
+                breakers = self._get(repository)
+            else:
+                breakers = sorted(self._breakers.values(),
+                                  key=lambda b: b.name)
+            return [b.describe(now) for b in breakers
+                        if b.state != b.CLOSED or b.failures]
+
+    def discard(self, repository):
+        ''' Forget a removed repository's breaker. '''
+        with self._lock:
+            self._breakers.pop('repo ' + repository.name, None)
+
+
+_BREAKERS = _Breakers()
+
+
+def _process_stats():
+    ''' Return (open file descriptors, resident set size kB) or None:s. '''
+    try:
+        fds = len(os.listdir('/proc/self/fd'))
+    except OSError:
+        fds = None
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        rss = pages * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        rss = None
+    return fds, rss
+
+
+def _retained_objects(root, limit=100000):
+    '''
+    Return number of objects reachable from root, not counting modules,
+    classes, functions, loggers and other objects of root's type. Stops
+    at limit.
+    '''
+    skip = (type, types.ModuleType, types.FunctionType, types.MethodType,
+            logging.Logger, type(root))
+    seen = set([id(root)])
+    todo = gc.get_referents(root)
+    while todo and len(seen) < limit:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, skip):
+            continue
+        seen.add(id(obj))
+        todo.extend(gc.get_referents(obj))
+    return len(seen) - 1
+
+
+class _MemoryDiagnostics(object):
+    '''
+    Memory growth diagnostics for fetch/poll cycles. The resident size
+    is recorded after each cycle. A memorySampleRate fraction of the
+    cycles is also measured: growth is counted per object type using the
+    gc. Sampled cycles also count objects retained by each repository.
+    A sampled cycle never ended is given up after STALE seconds.
+    '''
+
+    TOP = 5
+    STALE = 3600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = None           # (repo name, start time)
+        self._counts = None
+        self.rss = collections.deque(maxlen=48)
+        self.growth = None            # (repo name, [(type name, count)])
+        self.retained = {}
+
+    def begin(self, name):
+        ''' Start of cycle for repo name, maybe start sampling. '''
+        rate = config.global_option('memorySampleRate').value
+        if not rate or random.random() >= rate:
+            return
+        now = time.time()
+        with self._lock:
+            if self._active and now - self._active[1] < self.STALE:
+                return
+            self._active = (name, now)
+        self._counts = collections.Counter(
+            [type(o).__name__ for o in gc.get_objects()])
+
+    def end(self, repository):
+        ''' End of cycle for repository, record what was sampled. '''
+        rss = _process_stats()[1]
+        if rss:
+            self.rss.append((time.time(), rss))
+        with self._lock:
+            if not self._active or self._active[0] != repository.name:
+                return
+            self._active = None
+            start_counts, self._counts = self._counts, None
+        counts = collections.Counter(
+            [type(o).__name__ for o in gc.get_objects()])
+        counts.subtract(start_counts)
+        self.growth = (repository.name,
+                       [(name, n) for name, n in counts.most_common(self.TOP)
+                            if n > 0])
+        self.retained[repository.name] = _retained_objects(repository)
+
+    def forget(self, name):
+        ''' Drop data for a removed repository. '''
+        self.retained.pop(name, None)
+
+
+_MEMORY = _MemoryDiagnostics()
+
+
+class _Tracer(object):
+    '''
+    Optional tracing of fetch/poll cycles, written to traceFile as JSON
+    lines, one for each finished span. A traceSampleRate fraction of the
+    cycles is traced. Spans nest within a thread; a cycle moving to
+    another thread is continued there using activate().
+    '''
+
+    MAX_BYTES = 10 * 1024 * 1024
+    BACKUPS = 3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._path = None
+        self._logger = None
+
+    def _get_logger(self):
+        ''' Return logger writing to current traceFile, or None. '''
+        path = config.global_option('traceFile').value
+        with self._lock:
+            if path != self._path:
+                if self._logger:
+                    for handler in self._logger.handlers:
+                        handler.close()
+                self._logger = None
+                if path:
+                    # Standalone logger, not configured by supybot.
+                    self._logger = logging.Logger('git.trace')
+                    handler = logging.handlers.RotatingFileHandler(
+                        path, maxBytes=self.MAX_BYTES,
+                        backupCount=self.BACKUPS)
+                    handler.setFormatter(logging.Formatter('%(message)s'))
+                    self._logger.addHandler(handler)
+                self._path = path
+            return self._logger
+
+    def _stack(self):
+        ''' Return this thread's stack of (context, span id). '''
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def begin(self, reponame):
+        ''' Return context of a new cycle, None unless traced. '''
+        if not config.global_option('traceFile').value or \
+                random.random() >= \
+                    config.global_option('traceSampleRate').value:
+            return None
+        return {'trace': next(self._ids), 'span': next(self._ids),
+                'repo': reponame, 'start': time.time()}
+
+    def end(self, trace):
+        ''' Write the span covering the whole cycle. '''
+        if trace:
+            self.emit(trace, 'cycle', trace['start'], time.time(),
+                      trace['span'])
+
+    @contextlib.contextmanager
+    def activate(self, trace):
+        ''' Make spans in this thread part of the trace cycle. '''
+        stack = self._stack()
+        if trace:
+            stack.append((trace, trace['span']))
+        try:
+            yield
+        finally:
+            if trace:
+                stack.pop()
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        '''
+        Trace the enclosed code as a child of the current span, if any.
+        Yields the attributes dict which may be updated.
+        '''
+        stack = self._stack()
+        if not stack:
+            yield attrs
+            return
+        trace, parent = stack[-1]
+        span_id = next(self._ids)
+        stack.append((trace, span_id))
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            stack.pop()
+            self.emit(trace, name, start, time.time(), span_id, parent,
+                      **attrs)
+
+    def emit(self, trace, name, start, end, span_id=None, parent=None,
+             **attrs):
+        ''' Write a finished span, a child of the cycle by default. '''
+        logger = self._get_logger()
+        if not logger:
+            return
+        attrs.update({
+            'trace': trace['trace'],
+            'span': span_id or next(self._ids),
+            'parent': parent if span_id else trace['span'],
+            'name': name,
+            'repo': trace['repo'],
+            'thread': threading.current_thread().name,
+            'start': round(start, 6),
+            'end': round(end, 6)})
+        logger.info(json.dumps(attrs, sort_keys=True))
+
+
+_TRACER = _Tracer()
+
+
+@contextlib.contextmanager
+def _locked(repository):
+    ''' Hold repository.lock, tracing the time waiting for it. '''
+    with _TRACER.span('lock wait'):
+        repository.lock.acquire()
+    try:
+        yield
+    finally:
+        repository.lock.release()
+
+
+class _ExpiringSet(object):
+    '''
+    Bounded set of keys which expire a given time after being added,
+    oldest keys are dropped when full. Synchronized.
+    '''
+
+    def __init__(self, maxlen=1000):
+        self._lock = threading.Lock()
+        self._added = collections.OrderedDict()
+        self.maxlen = maxlen
+
+    def add(self, key, ttl):
+        '''
+        Add key living for ttl seconds. Returns False if key was already
+        present and not expired, else True.
+        '''
+        now = time.time()
+        with self._lock:
+            while self._added:
+                oldest, when = next(self._added.iteritems())
+                if when > now - ttl and len(self._added) < self.maxlen:
+                    break
+                del self._added[oldest]
+            if key in self._added:
+                return False
+            self._added[key] = now
+            return True
+
+
+class _SharedClone(object):
+    '''
+    Coordinates bot processes sharing a clone in sharedMode. The process
+    holding an exclusive flock on <clone>.lock is the leader: it fetches,
+    then publishes the watched branch tips and the fetched ranges in
+    <clone>.state.json. The others only read the published state. When
+    the leader exits the lock is released and another process takes over
+    at its next fetch.
+    '''
+
+    def __init__(self, path):
+        self.lock_path = path + '.lock'
+        self.state_path = path + '.state.json'
+        self._fd = None
+
+    def lead(self):
+        ''' Try to become leader unless already, return True if leader. '''
+        if self._fd is None:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                return False
+            self._fd = fd
+        return True
+
+    def release(self):
+        ''' Give up leadership, if held. '''
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def publish(self, tips):
+        ''' Atomically replace state with tips, branch -> sha dict. '''
+        old = self.read() or {'tips': {}, 'serial': 0}
+        ranges = dict([(b, [old['tips'].get(b), sha])
+                       for b, sha in tips.iteritems()
+                       if old['tips'].get(b) != sha])
+        state = {'tips': tips, 'ranges': ranges, 'time': time.time(),
+                 'serial': old['serial'] + 1}
+        tmp = '%s.%d' % (self.state_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(tmp, self.state_path)
+
+    def read(self):
+        ''' Return the published state, or None. '''
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
 class _Repository(object):
     """
     Represents a git repository being monitored. The repository is a
@@ -219,8 +1241,18 @@ class _Repository(object):
             if get_value('snarfMessage2'):
                 self.snarf_msg += "\n" + get_value('snarfMessage2')
             self.group_header = get_value('groupHeader')
+            self.announce_branches = get_value('announceBranches')
             self.enable_snarf = get_value('enableSnarf')
+            self.commit_catalog = get_value('commitCatalog')
             self.timeout = get_value('fetchTimeout')
+            self.track_tags = get_value('trackTags')
+            self.odb_backend = get_value('odbBackend')
+            self.tag_msg = get_value('tagMessage')
+            self.diffstat = bool(_DIFFSTAT_RE.search('\n'.join(
+                [self.commit_msg, self.snarf_msg, self.tag_msg])))
+            # Registered here, read per channel by _Repository.filters().
+            get_value('paths')
+            get_value('authors')
 
     def __init__(self, reponame):
         """
@@ -231,202 +1263,1228 @@ class _Repository(object):
         self.options = self.Options(reponame)
         self.name = reponame
         self.commit_by_branch = {}
+        self.recent = {}
+        self.new_heads = {}
         self.lock = threading.Lock()
-        self.repo = None
+        self.catalog = None
+        self._pending = set()
+        # Branches polled without updating the catalog, see fetch().
+        self._catalog_behind = set()
+        self._matcher = _BranchMatcher(self.options.branches)
+        self._remote_heads = {}
+        self.branch_events = []
+        self.tags = None
+        self._tags_by_commit = {}
+        self.tag_events = []
+        self._diffstats = collections.OrderedDict()
+        self._diffstats_lock = threading.Lock()
+        self.maintained = None
+        self._fetching = None
+        self._maintaining = None
+        self._fetching_lock = threading.Lock()
         self.path = os.path.join(self.options.repo_dir, self.name)
+        self.shared = None
+        self._published = None
+        if config.global_option('sharedMode').value:
+            if fcntl:
+                self.shared = _SharedClone(self.path)
+            else:
+                self.log.error("sharedMode requires fcntl, ignored")
         if world.testing:
             self._clone()
             self.init()
 
     branches = property(lambda self: self.commit_by_branch.keys())
 
+    maintaining = property(lambda self: self._maintaining is not None,
+                           doc = 'True while maintain() runs.')
+
+    following = property(
+        lambda self: bool(self.shared) and not self.shared.lead(),
+        doc = 'True if another process fetches this shared clone.')
+
+    repo = property(lambda self: _HANDLES.get(self.path,
+                                              self.options.odb_backend),
+                    doc = 'GitPython Repo, opened through the pool.')
+
     @staticmethod
-    def create(reponame, cloning_done_cb = lambda x: True, opts = None):
+    def create(reponame, cloning_done_cb = lambda x: True):
         '''
         Create a new repository, clone and invoke cloning_done_cb on main
         thread. callback is called with a _Repository or an error msg.
-        opts need to contain at least url and channels.
+        The registry options, at least url and channels, must be set. The
+        registry isn't modified here, this runs on worker threads.
         '''
-        if opts:
-            for key, value in opts.iteritems():
-                config.repo_option(reponame, key).setValue(value)
-        r = _Repository(reponame)
         try:
+            r = _Repository(reponame)
             r._clone()                             # pylint: disable=W0212
             r.init()
             todo = lambda: cloning_done_cb(r)
         except (git.GitCommandError, git.exc.NoSuchPathError) as e:
             todo = lambda: cloning_done_cb(str(e))
-        _Scheduler.run_callback(todo, 'clonecallback')
+        _Scheduler.run_callback(todo, 'clonecallback-' + reponame)
 
     def _clone(self):
         "Fix directories and run git-clone"
         if not os.path.exists(self.options.repo_dir):
             os.makedirs(self.options.repo_dir)
         if os.path.exists(self.path):
+            if self.shared:
+                return
             shutil.rmtree(self.path)
         git.Git('.').clone(self.options.url, self.path, no_checkout=True)
 
+    def _fetch_remote(self):
+        '''
+        Fetch the remote branches which may match the branches option to
+        refs/remotes/origin, pruning deleted ones. Only refs below the
+        patterns' literal prefixes are requested. Using protocol v2, other
+        refs aren't even advertised by the server. Killed after fetchTimeout
+        seconds unless 0.
+        '''
+        args = ['git']
+        if _git_version() >= (2, 18):
+            args.extend(['-c', 'protocol.version=2'])
+        args.extend(['fetch', '--prune', '--no-tags', '--quiet', 'origin'])
+        args.extend(self._matcher.refspecs())
+        if self.options.track_tags:
+            args.append('+refs/tags/*:refs/tags/*')
+        # Keep the wrapper, it closes the pipes when collected.
+        handle = self.repo.git.execute(args, as_process=True)
+        proc = handle.proc
+        timer = None
+        if self.options.timeout:
+            timer = threading.Timer(self.options.timeout, proc.kill)
+            timer.start()
+        try:
+            stderr = proc.communicate()[1]
+        finally:
+            if timer:
+                timer.cancel()
+        if proc.returncode != 0:
+            raise git.GitCommandError(args, proc.returncode, stderr)
+
+    def _update_local_branches(self, branches):
+        '''
+        Fast-forward local branches to the fetched remote ones, without
+        contacting the remote.
+        '''
+        if branches:
+            self.repo.git.fetch('--update-head-ok', '--quiet', '.',
+                                *['refs/remotes/origin/%s:refs/heads/%s' %
+                                      (b, b) for b in branches])
+
+    def _track_branch(self, branch):
+        ''' Start watching a fetched branch from current head. '''
+        repo = self.repo
+        try:
+            self._update_local_branches([branch])
+            self.commit_by_branch[branch] = repo.commit(branch).hexsha
+            self._fill_recent(branch)
+        except git.GitCommandError as e:
+            self.log.error("Cannot checkout repo branch: " + branch)
+            raise e
+        if self.catalog:
+            self.catalog.backfill(repo, branch)
+
+    def _open_catalog(self):
+        '''
+        Open the commit catalog if enabled, else drop it. A new catalog
+        is backfilled with all watched branches.
+        '''
+        if not self.options.commit_catalog:
+            self.catalog = None
+            return
+        repo = self.repo
+        path = os.path.join(repo.git_dir, 'supybot-catalog.sqlite')
+        self.catalog = _CommitCatalog(path)
+        if self.following:
+            return
+        if self.catalog.outdated:
+            for branch in self.commit_by_branch:
+                self.catalog.backfill(repo, branch)
+            self.catalog.set_current()
+        else:
+            for branch in self.commit_by_branch:
+                self._sync_catalog(branch)
+
+    def _sync_catalog(self, branch, head=None):
+        '''
+        Add commits made while not polling up to head, by default the
+        last polled one. Backfill if needed.
+        '''
+        top = self.catalog.head(branch)
+        head = head or self.commit_by_branch[branch]
+        if top == head:
+            return
+        repo = self.repo
+        try:
+            if top:
+                repo.git.merge_base(top, head, is_ancestor=True)
+        except git.GitCommandError:
+            top = None
+        if top:
+            rev = '%s..%s' % (top, head)
+            self.catalog.add(branch, list(_iter_log(repo, rev, '--')))
+        else:
+            self.catalog.backfill(repo, branch)
+
+    def _read_heads(self, prefix):
+        ''' Return dict of branch name -> sha for refs below prefix. '''
+        output = self.repo.git.for_each_ref(
+            prefix, format='%(objectname) %(refname)')
+        heads = {}
+        for line in output.splitlines():
+            sha, ref = line.split(' ', 1)
+            branch = ref[len(prefix):]
+            if branch != 'HEAD':
+                heads[branch] = sha
+        return heads
+
+    def _read_remote_heads(self):
+        ''' Return dict of remote branch name -> sha for origin. '''
+        return self._read_heads('refs/remotes/origin/')
+
+    def _rescan_branches(self):
+        '''
+        Update watched branches after a change of the branches option.
+        Branches still watched keep their last seen commit.
+        '''
+        self._matcher = _BranchMatcher(self.options.branches)
+        branches = _get_branches(self._matcher, self._remote_heads)
+        for branch in set(self.commit_by_branch) - set(branches):
+            del self.commit_by_branch[branch]
+            self.recent.pop(branch, None)
+            if self.catalog:
+                self.catalog.drop_branch(branch)
+        for branch in set(branches) - set(self.commit_by_branch):
+            self._track_branch(branch)
+        self.log.info("Rescanned branches for %s: %s" %
+                      (self.name, ', '.join(self.branches)))
+
+    def _add_branch_event(self, event, branch):
+        ''' Queue a branch event for next poll if branches are announced. '''
+        if self.options.announce_branches:
+            self.branch_events.append((event, branch))
+
+    def _update_branches(self):
+        '''
+        Diff remote branches against the previous snapshot. Created
+        branches matching the branches option are tracked, deleted ones
+        dropped. Only changed refs are matched against the patterns.
+        Return True if any remote branch is created, deleted or moved.
+        '''
+        heads = self._read_remote_heads()
+        created = [b for b in heads if b not in self._remote_heads]
+        deleted = [b for b in self._remote_heads if b not in heads]
+        changed = heads != self._remote_heads
+        # Created branches are added when tracked, retried if it fails.
+        self._remote_heads = dict([(b, sha) for b, sha in heads.iteritems()
+                                       if b not in created])
+        for branch in deleted:
+            if branch in self.commit_by_branch:
+                del self.commit_by_branch[branch]
+                self.recent.pop(branch, None)
+                if self.catalog:
+                    self.catalog.drop_branch(branch)
+                self._add_branch_event('deleted', branch)
+                self.log.info("Branch %s deleted at %s" %
+                              (branch, self.name))
+        for branch in created:
+            if self._matcher.match(branch) and \
+                    branch not in self.commit_by_branch:
+                self._track_branch(branch)
+                self._add_branch_event('created', branch)
+                self.log.info("Branch %s created at %s" %
+                              (branch, self.name))
+            self._remote_heads[branch] = heads[branch]
+        return changed
+
+    def _read_tags(self):
+        ''' Return dict of tag name -> (sha, peeled sha). '''
+        output = self.repo.git.for_each_ref(
+            'refs/tags/', format='%(objectname) %(*objectname) %(refname)')
+        tags = {}
+        for line in output.splitlines():
+            sha, peeled, ref = line.split(' ', 2)
+            tags[ref[len('refs/tags/'):]] = (sha, peeled or sha)
+        return tags
+
+    # Fields separated by \x01. Tagger fields are empty for lightweight
+    # tags, author fields for annotated ones.
+    _TAG_FORMAT = '%01'.join([
+        '%(refname)', '%(objectname)', '%(*objectname)', '%(taggername)',
+        '%(taggeremail)', '%(authorname)', '%(authoremail)',
+        '%(creatordate:unix)', '%(contents:subject)'])
+
+    def _describe_tags(self, names, batch=500):
+        ''' Return dict of tag name -> _CommitSummary describing it. '''
+        summaries = {}
+        refs = ['refs/tags/' + name for name in names]
+        for i in range(0, len(refs), batch):
+            output = self.repo.git.for_each_ref(
+                *refs[i:i + batch], format=self._TAG_FORMAT)
+            for line in output.decode('utf-8', 'replace').splitlines():
+                ref, sha, peeled, tagger, tagger_email, author, \
+                    author_email, date, subject = line.split('\x01', 8)
+                name = ref[len('refs/tags/'):]
+                if name not in names:
+                    continue
+                summaries[name] = _CommitSummary(
+                    peeled or sha, tagger or author,
+                    (tagger_email or author_email).strip('<>'),
+                    int(date or 0), subject)
+        return summaries
+
+    def _update_tags(self):
+        '''
+        Diff the tags against the snapshot taken at previous fetch, if
+        tags are tracked. Add ('created'|'moved'|'deleted', tag, summary)
+        tuples to tag_events, summary is None for deleted tags. Nothing
+        is added on the first snapshot. Return True if any tag changed.
+        '''
+        if not self.options.track_tags:
+            self.tags = None
+            self._tags_by_commit = {}
+            return False
+        tags = self._read_tags()
+        old = self.tags
+        if tags == old:
+            return False
+        self.tags = tags
+        by_commit = {}
+        for name, (sha, peeled) in tags.iteritems():
+            by_commit.setdefault(peeled, []).append(name)
+        self._tags_by_commit = by_commit
+        if old is None:
+            return False
+        for name in sorted(set(old) - set(tags)):
+            self.tag_events.append(('deleted', name, None))
+        changed = dict([(name, 'created') for name in tags
+                            if name not in old])
+        changed.update([(name, 'moved') for name in tags
+                            if name in old and tags[name] != old[name]])
+        summaries = self._describe_tags(changed)
+        for name in sorted(summaries,
+                           key=lambda n: summaries[n].committed_date):
+            self.tag_events.append((changed[name], name, summaries[name]))
+        return True
+
+    def tags_at(self, sha):
+        ''' Return sorted list of tracked tags on commit sha. '''
+        return sorted(self._tags_by_commit.get(sha, []))
+
+    def _follow(self):
+        '''
+        Update watched branches from the state published by the leader
+        process of a shared clone. Return True if anything changed.
+        '''
+        state = self.shared.read()
+        if not state:
+            return False
+        tips = state['tips']
+        initial = self._published is None
+        changed = tips != self._published
+        self._published = tips
+        # The snapshot _update_branches() diffs against when taking over.
+        self._remote_heads = self._read_remote_heads()
+        for branch in [b for b in self.commit_by_branch if b not in tips]:
+            del self.commit_by_branch[branch]
+            self.recent.pop(branch, None)
+            self._add_branch_event('deleted', branch)
+        created = [b for b in tips if b not in self.commit_by_branch]
+        for branch in self._matcher.filter(created):
+            self.commit_by_branch[branch] = tips[branch]
+            if not initial:
+                self._add_branch_event('created', branch)
+        return changed
+
+    def _publish(self):
+        ''' Leader of a shared clone: publish watched branch tips. '''
+        heads = self._read_heads('refs/heads/')
+        self.shared.publish(dict([(b, heads[b]) for b in self.branches
+                                  if b in heads]))
+
     def init(self):
         ''' Lazy init invoked when a clone exists, reads repo data. '''
-        self.repo = git.Repo(self.path)
         self.commit_by_branch = {}
-        for branch in _get_branches(self.options.branches, self.repo):
-            try:
-                if str(self.repo.active_branch) == branch:
-                    self.repo.remote().pull(branch)
-                else:
-                    self.repo.remote().fetch(branch + ':' + branch)
-                self.commit_by_branch[branch] = self.repo.commit(branch)
-            except git.GitCommandError as e:
-                self.log.error("Cannot checkout repo branch: " + branch)
-                raise e
+        self.recent = {}
+        self.tags = None
+        if self.following:
+            self._follow()
+            self._update_tags()
+            self._open_catalog()
+            self.maintained = self._read_maintained()
+            return self
+        self._fetch_remote()
+        self._remote_heads = self._read_remote_heads()
+        for branch in _get_branches(self._matcher, self._remote_heads):
+            self._track_branch(branch)
+        self._update_tags()
+        self._open_catalog()
+        if self.shared:
+            self._publish()
+        self.maintained = self._read_maintained()
         return self
 
+    def reconfigure(self, option):
+        '''
+        Apply a changed registry option. A new options snapshot is all
+        most options need; work requiring remote access is deferred to
+        next fetch().
+        '''
+        self.options = self.Options(self.name)
+        if option in ['branches', 'url', 'commitCatalog']:
+            self._pending.add(option)
+        elif option == 'odbBackend':
+            # Reopened using the new backend when next used.
+            _HANDLES.discard(self.path)
+
     def fetch(self):
-        "Contact git repository and update branches appropriately."
-        self.repo.remote().update()
-        for branch in self.branches:
-            try:
-                timer = threading.Timer(self.options.timeout, lambda: [][5])
-                timer.start()
-                if str(self.repo.active_branch) == branch:
-                    self.repo.remote().pull(branch)
+        '''
+        Contact git repository and update branches appropriately. Return
+        True if anything changed in the remote since last fetch. In a
+        shared clone, only the leader fetches; others read what it
+        published.
+        '''
+        if self.following:
+            changed = self._follow()
+            changed = self._update_tags() or changed
+            self._prepare_diffstats()
+            return changed
+        pending = set()
+        while self._pending:
+            pending.add(self._pending.pop())
+        try:
+            repo = self.repo
+            if 'url' in pending:
+                repo.git.remote('set-url', 'origin', self.options.url)
+            if 'branches' in pending:
+                # Fetch using the new patterns.
+                self._matcher = _BranchMatcher(self.options.branches)
+            with _TRACER.span('ref update'):
+                self._fetch_remote()
+                if 'branches' in pending:
+                    self._remote_heads = self._read_remote_heads()
+                    self._rescan_branches()
+                    changed = True
                 else:
-                    self.repo.remote().fetch(branch + ':' + branch)
-                timer.cancel()
-            except IndexError:
-                self.log.error('Timeout in fetch() for %s at %s' %
-                                   (branch, self.name))
-            except (OSError, git.GitCommandError) as e:
-                self.log.error("Problem accessing local repo: " +
-                               str(e))
+                    changed = self._update_branches()
+                changed = self._update_tags() or changed
+            if 'commitCatalog' in pending:
+                self._open_catalog()
+        except Exception:
+            # Applied again by next fetch.
+            self._pending.update(pending)
+            raise
+        try:
+            self._update_local_branches(self.branches)
+        except (OSError, git.GitCommandError) as e:
+            self.log.error("Problem accessing local repo: " + str(e))
+        self._sync_catalog_behind()
+        if self.shared:
+            self._publish()
+        self._prepare_diffstats()
+        return changed
+
+    def _sync_catalog_behind(self):
+        ''' Add commits skipped by skip_new_commits() to the catalog. '''
+        while self._catalog_behind:
+            branch = self._catalog_behind.pop()
+            if self.catalog and branch in self.commit_by_branch:
+                self._sync_catalog(branch)
+
+    def lookup(self, shas):
+        '''
+        Return dict sha -> _CommitSummary for the commits which have the
+        given shas as unambiguous prefixes, unknown ones are omitted. The
+        catalog is used if available, remaining shas are looked up in a
+        single git log. If git rejects one of them, e. g. as ambiguous,
+        each is looked up separately.
+        '''
+        found = {}
+        if self.catalog:
+            found.update(self.catalog.lookup(shas))
+        missing = [sha for sha in shas if sha not in found]
+        if not missing:
+            return found
+        args = ['--no-walk=unsorted', '--ignore-missing']
+        args.extend([sha + '^{commit}' for sha in missing])
+        try:
+            commits = list(_iter_log(self.repo, *(args + ['--'])))
+        except git.GitCommandError as e:
+            self.log.debug("Cannot look up %s: %s" % (missing, e))
+            if len(missing) > 1:
+                for sha in missing:
+                    found.update(self.lookup([sha]))
+            return found
+        for commit, message in commits:
+            for sha in missing:
+                if commit.hexsha.startswith(sha):
+                    found[sha] = commit
+        return found
+
+    def fetch_once(self):
+        '''
+        Run fetch() holding self.lock, unless another thread is already
+        doing so. In this case wait for it to complete instead of fetching
+        again. A running maintain() is waited for before fetching. Return
+        the fetch() result, or None if fetched by another thread.
+        '''
+        while True:
+            with self._fetching_lock:
+                running = self._fetching
+                maintaining = self._maintaining
+                if not running and not maintaining:
+                    self._fetching = threading.Event()
+            if not maintaining:
+                break
+            maintaining.wait()
+        if running:
+            running.wait()
+            return None
+        try:
+            with _locked(self):
+                changed = self.fetch()
+            _BREAKERS.record(self)
+            return changed
+        except Exception as e:
+            _BREAKERS.record(self, e)
+            raise
+        finally:
+            with self._fetching_lock:
+                done, self._fetching = self._fetching, None
+            done.set()
+
+    _MAINTAINED_FILE = 'supybot-maintenance'
+
+    def _read_maintained(self):
+        ''' Return (time, ms before, ms after) of last maintain() or None. '''
+        path = os.path.join(self.repo.git_dir, self._MAINTAINED_FILE)
+        try:
+            with open(path) as f:
+                return tuple([float(w) for w in f.read().split()])
+        except (IOError, ValueError):
+            return None
+
+    def _walk_time(self):
+        ''' Return ms used for a rev walk of all watched branches. '''
+        start = time.time()
+        if self.branches:
+            self.repo.git.rev_list('--count', *(self.branches + ['--']))
+        return (time.time() - start) * 1000
+
+    # Command prefix running maintenance at idle CPU and IO priority.
+    _LOW_PRIORITY = sum([cmd for cmd in [['nice', '-n', '19'],
+                                         ['ionice', '-c', '3']]
+                             if distutils.spawn.find_executable(cmd[0])],
+                        [])
 
-    def get_commit(self, sha):
-        "Fetch the commit with the given SHA, throws BadObject."
-        return self.repo.commit(sha)
+    def maintain(self):
+        '''
+        Update the commit-graph, pack loose objects and prune unreachable
+        ones older than two weeks. The repack is incremental and uses a
+        single thread. git runs at low priority. Fetches are kept out
+        while maintaining: nothing is done if one is running, and
+        fetch_once() waits until done. Polls aren't, self.lock is only
+        held while writing the commit-graph which reads the refs. Records
+        rev walk times before and after in self.maintained, or the time
+        of a failure and None. Only the leader maintains a shared clone.
+        Return False if not maintained as busy or following. Throws
+        GitCommandError.
+        '''
+        if self.following:
+            return False
+        with self._fetching_lock:
+            if self._fetching:
+                return False
+            self._maintaining = threading.Event()
+        try:
+            self._maintain()
+        finally:
+            with self._fetching_lock:
+                done, self._maintaining = self._maintaining, None
+            done.set()
+        return True
+
+    def _maintain(self):
+        ''' Run maintain() steps, caller keeps fetches out. '''
+        repo = self.repo
+
+        def git_low(*args):
+            ''' Run git args at low priority. '''
+            repo.git.execute(self._LOW_PRIORITY + ['git'] + list(args))
+
+        try:
+            before = self._walk_time()
+            git_low('-c', 'pack.threads=1', 'repack', '-d', '-l', '-q')
+            git_low('prune', '--expire=2.weeks.ago')
+            with _locked(self):
+                git_low('commit-graph', 'write', '--reachable', '--split')
+            after = self._walk_time()
+        except git.GitCommandError:
+            # Retried after maintenancePeriod like a successful run.
+            self.maintained = (time.time(), None, None)
+            raise
+        self.maintained = (time.time(), before, after)
+        path = os.path.join(repo.git_dir, self._MAINTAINED_FILE)
+        with open(path, 'w') as f:
+            f.write('%d %.1f %.1f\n' % self.maintained)
+        self.log.info("Maintained %s, rev walk %.1f ms -> %.1f ms" %
+                      (self.name, before, after))
+
+    def _new_range(self, heads=None):
+        '''
+        Return rev-list arguments for commits reachable from heads, by
+        default those found by last poll, but not from polled ones.
+        '''
+        if heads is None:
+            heads = self.new_heads.values()
+        args = sorted(set(heads))
+        args.extend(['^' + old
+                        for old in set(self.commit_by_branch.values())])
+        return args
+
+    # Max number of cached diffstats.
+    DIFFSTATS = 1000
+
+    def diffstats(self, shas):
+        '''
+        Return dict sha -> (files, added, removed) for the given commit
+        shas. The ones not cached are computed in a single git call, those
+        which can't be computed are omitted.
+        '''
+        with self._diffstats_lock:
+            found = dict([(sha, self._diffstats[sha])
+                              for sha in shas if sha in self._diffstats])
+        missing = [sha for sha in shas if sha not in found]
+        if missing:
+            try:
+                stats = _numstat(self.repo, '--no-walk=unsorted',
+                                 *(missing + ['--']))
+            except git.GitCommandError as e:
+                self.log.error("Cannot compute diffstats: " + str(e))
+                return found
+            self._cache_diffstats(stats)
+            found.update(stats)
+        return found
+
+    def _cache_diffstats(self, stats):
+        ''' Add dict of sha -> diffstat to the bounded cache. '''
+        with self._diffstats_lock:
+            for sha, stat in stats.iteritems():
+                self._diffstats.pop(sha, None)
+                self._diffstats[sha] = stat
+            while len(self._diffstats) > self.DIFFSTATS:
+                self._diffstats.popitem(last=False)
+
+    def _prepare_diffstats(self):
+        '''
+        If the formats use diffstats, compute them for the commits next
+        poll will announce while fetching, rather than when formatting on
+        the main thread. Errors are logged, the stats are then computed
+        when needed.
+        '''
+        if not self.options.diffstat:
+            return
+        if self.following:
+            heads = self._published or {}
+        else:
+            heads = self._read_heads('refs/heads/')
+        new = [heads[b] for b, old in self.commit_by_branch.iteritems()
+                   if heads.get(b, old) != old]
+        if not new:
+            return
+        limit = config.global_option('maxCommitsAtOnce').value * len(new)
+        with _TRACER.span('diffstat'):
+            try:
+                self._cache_diffstats(_numstat(
+                    self.repo, '-n', str(max(limit, 1)),
+                    *(self._new_range(new) + ['--'])))
+            except git.GitCommandError as e:
+                self.log.error("Cannot compute diffstats: " + str(e))
+
+    def filters(self, channel):
+        '''
+        Return (paths, authors) tuple of tuples limiting the commits
+        announced in channel, empty if not limited.
+        '''
+        return (tuple(config.channel_option(self.name, 'paths', channel)),
+                tuple(config.channel_option(self.name, 'authors', channel)))
+
+    def filter_new_commits(self, commits_by_branch, filters):
+        '''
+        Return commits_by_branch from get_new_commits() with only the
+        commits matching filters from filters(). The polled range is walked
+        by git using pathspecs and author limiting, the commits are never
+        read here.
+        '''
+        paths, authors = filters
+        if not commits_by_branch or not (paths or authors):
+            return commits_by_branch
+        args = ['--regexp-ignore-case', '--fixed-strings']
+        args.extend(['--author=' + author for author in authors])
+        args.extend(self._new_range())
+        args.append('--')
+        args.extend(paths)
+        with _TRACER.span('rev walk', filtered=True) as span:
+            shas = set(self.repo.git.rev_list(*args).split())
+            span['commits'] = len(shas)
+        result = {}
+        for key, commits in commits_by_branch.iteritems():
+            commits = [c for c in commits if c.hexsha in shas]
+            if commits:
+                result[key] = commits
+        return result
+
+    def _find_new_heads(self):
+        ''' Store the watched branches' heads which moved in new_heads. '''
+        if self.following:
+            heads = self._published or {}
+        else:
+            heads = self._read_heads('refs/heads/')
+        self.new_heads = {}
+        for branch, old in self.commit_by_branch.iteritems():
+            head = heads.get(branch)
+            if head and head != old:
+                self.new_heads[branch] = head
+
+    def count_new_commits(self):
+        '''
+        Return number of commits get_new_commits() would find, without
+        reading them. Stores new_heads.
+        '''
+        self._find_new_heads()
+        if not self.new_heads:
+            return 0
+        with _TRACER.span('rev count'):
+            return int(self.repo.git.rev_list(
+                '--count', *(self._new_range() + ['--'])))
+
+    def get_digest(self, filters=((), ())):
+        '''
+        Summarize the commits counted by count_new_commits(), limited by
+        filters from filters(). Return list of (branch, count, authors,
+        first, last) for each moved branch with matching commits. authors
+        is a list of (count, name) tuples, most active first. first and
+        last are the oldest and newest commit as _CommitSummary. git only
+        counts and lists shas, just these two commits are read.
+        '''
+        paths, authors = filters
+        limits = []
+        if authors:
+            limits = ['--regexp-ignore-case', '--fixed-strings']
+            limits.extend(['--author=' + author for author in authors])
+        olds = ['^' + old for old in set(self.commit_by_branch.values())]
+        digest = []
+        for branch in sorted(self.new_heads):
+            args = limits + [self.new_heads[branch]] + olds + ['--']
+            args.extend(paths)
+            counts = []
+            for line in self.repo.git.shortlog('-s', '-n', *args) \
+                    .decode('utf-8', 'replace').splitlines():
+                count, name = line.strip().split('\t', 1)
+                counts.append((int(count), name))
+            if not counts:
+                continue
+            last = next(_iter_log(self.repo, '-n', '1', *args))[0]
+            first = self.repo.git.rev_list('--reverse', *args) \
+                .split('\n', 1)[0]
+            first = next(_iter_log(self.repo, '-n', '1', first, '--'))[0]
+            digest.append((branch, sum([c for c, n in counts]), counts,
+                           first, last))
+        return digest
+
+    def skip_new_commits(self):
+        '''
+        Accept the commits counted by count_new_commits() without reading
+        them, as when a digest is shown. The catalog is updated by next
+        fetch(), off the poll thread; recent commit buffers are refilled
+        when used.
+        '''
+        if self.catalog and not self.following:
+            self._catalog_behind.update(self.new_heads)
 
     def get_new_commits(self):
         '''
-        Return dict of commits by branch which are more recent then those
-        in self.commit_by_branch
+        Return dict of _CommitSummary lists, newest first, for commits
+        more recent than those in self.commit_by_branch. All moved heads
+        are walked once, excluding everything reachable from previously
+        seen heads. Each commit's branches lists the branches it reached,
+        the dict is keyed by these as a comma-separated string. The
+        walked heads are stored in new_heads, commits are also added to
+        the catalog and the recent commit buffers. A branch which reached
+        commits already seen on another branch, e. g. by a merge, is
+        synced to the catalog from its old head instead.
         '''
+        following = self.following
+        self._find_new_heads()
+        if not self.new_heads:
+            return {}
+        with _TRACER.span('rev walk') as span:
+            commits = list(_iter_log(self.repo,
+                                     *(self._new_range() + ['--'])))
+            span['commits'] = len(commits)
+        by_sha = dict([(c.hexsha, c) for c, message in commits])
+        partial = set()
+        for branch, head in self.new_heads.iteritems():
+            old = self.commit_by_branch[branch]
+            forward = False
+            todo = [head]
+            while todo:
+                sha = todo.pop()
+                forward = forward or sha == old
+                commit = by_sha.get(sha)
+                if commit is None:
+                    if sha != old:
+                        partial.add(branch)
+                    continue
+                if branch in (commit.branches or []):
+                    continue
+                commit.branches = (commit.branches or []) + [branch]
+                todo.extend(commit.parents)
+            self._update_recent(branch, old, head,
+                                forward and branch not in partial,
+                                [c for c, m in commits
+                                     if branch in c.branches])
+        if self.catalog and not following:
+            for branch, head in self.new_heads.iteritems():
+                if branch in partial or branch in self._catalog_behind:
+                    # Reached commits seen on another branch, or skipped
+                    # ones: the walk doesn't hold all commits missing.
+                    self._catalog_behind.discard(branch)
+                    self._sync_catalog(branch, head)
+                else:
+                    self.catalog.add(branch, [(c, m) for c, m in commits
+                                                  if branch in c.branches])
         new_commits_by_branch = {}
-        for branch in self.commit_by_branch:
-            rev = "%s..%s" % (self.commit_by_branch[branch], branch)
-            # Workaround for GitPython bug:
-            # https://github.com/gitpython-developers/GitPython/issues/61
-            self.repo.odb.update_cache()
-            results = list(self.repo.iter_commits(rev))
-            new_commits_by_branch[branch] = results
-            self.log.debug("Poll: branch: %s last commit: %s, %d commits" %
-                           (branch, str(self.commit_by_branch[branch])[:7],
-                                        len(results)))
+        for commit, message in commits:
+            key = ','.join(sorted(commit.branches or ()))
+            new_commits_by_branch.setdefault(key, []).append(commit)
+        self.log.debug("Poll: %s: %d commits on %s" %
+                       (self.name, len(commits),
+                        ', '.join(self.new_heads.keys())))
         return new_commits_by_branch
 
+    # Size of the per-branch ring buffers of recent commits.
+    RECENT_COMMITS = 20
+
+    def _fill_recent(self, branch):
+        '''
+        Read the latest commits on branch, as last polled, to its ring
+        buffer. Return the (head, deque) buffer.
+        '''
+        head = self.commit_by_branch[branch]
+        commits = [c for c, message in
+                       _iter_log(self.repo, '-n', str(self.RECENT_COMMITS),
+                                 head, '--')]
+        self.recent[branch] = \
+            (head, collections.deque(commits, self.RECENT_COMMITS))
+        return self.recent[branch]
+
+    def _update_recent(self, branch, old, head, forward, commits):
+        '''
+        Push the commits polled on branch, newest first, to its ring
+        buffer. A buffer not at old, or a branch which isn't cleanly
+        fast-forwarded from old by commits, is dropped and refilled when
+        needed. The buffer is replaced rather than modified, readers may
+        hold the old one.
+        '''
+        recent = self.recent.pop(branch, None)
+        if not recent or recent[0] != old or not forward:
+            return
+        buf = collections.deque(commits[:self.RECENT_COMMITS],
+                                self.RECENT_COMMITS)
+        buf.extend(itertools.islice(recent[1], 0, buf.maxlen - len(buf)))
+        self.recent[branch] = (head, buf)
+
     def get_recent_commits(self, branch, count):
-        ''' Return count top commits for a branch in a repo. '''
-        return list(self.repo.iter_commits(branch))[:count]
+        '''
+        Return count top commits for a branch in a repo, newest first.
+        Up to RECENT_COMMITS are served from the ring buffer, else from
+        the catalog if available. Throws GitCommandError.
+        '''
+        head = self.commit_by_branch.get(branch)
+        if head and count <= self.RECENT_COMMITS:
+            recent = self.recent.get(branch)
+            if not recent or recent[0] != head:
+                recent = self._fill_recent(branch)
+            return list(recent[1])[:count]
+        if self.catalog:
+            commits = self.catalog.recent(branch, count)
+            if commits:
+                return commits
+        return [c for c, message in
+                    _iter_log(self.repo, '-n', str(count), branch, '--')]
 
 
 class _Repos(object):
     '''
     Synchronized access to the list of _Repository and related
-    conf settings.
+    conf settings. Also maintains routing indexes mapping channels to
+    repositories and repositories to the (irc, channel) pairs to notify.
+    These are rebuilt when the list changes and by reindex(), which
+    should be called when the bot joins or leaves a channel.
     '''
 
     def __init__(self):
         self._lock = threading.Lock()
         self._list = []
+        self._by_channel = ircutils.IrcDict()
+        self._snarf_by_channel = ircutils.IrcDict()
+        self._targets = {}
         for repo in config.global_option('repolist').value:
             self.append(_Repository(repo).init())
 
+    def _reindex(self):
+        ''' Rebuild all routing indexes, caller holds the lock. '''
+        by_channel = ircutils.IrcDict()
+        snarf_by_channel = ircutils.IrcDict()
+        targets = {}
+        for r in self._list:
+            targets[r.name] = []
+            for channel in r.options.channels:
+                by_channel.setdefault(channel, []).append(r)
+                if r.options.enable_snarf:
+                    snarf_by_channel.setdefault(channel, []).append(r)
+        for irc in world.ircs:
+            for channel in irc.state.channels:
+                for r in by_channel.get(channel, []):
+                    targets[r.name].append((irc, channel))
+        self._by_channel = by_channel
+        self._snarf_by_channel = snarf_by_channel
+        self._targets = targets
+
+    def _update(self):
+        ''' Store repolist and rebuild indexes, caller holds the lock. '''
+        repolist = [r.name for r in self._list]
+        config.global_option('repolist').setValue(repolist)
+        self._reindex()
+
     def set(self, repositories):
         ''' Update the repository list. '''
         with self._lock:
             self._list = repositories
-            repolist = [r.name for r in repositories]
-            config.global_option('repolist').setValue(repolist)
+            self._update()
 
     def append(self, repository):
         ''' Add new repository to shared list. '''
         with self._lock:
             self._list.append(repository)
-            repolist = [r.name for r in self._list]
-            config.global_option('repolist').setValue(repolist)
+            self._update()
 
     def remove(self, repository):
         ''' Remove repository from list. '''
         with self._lock:
             self._list.remove(repository)
-            repolist = [r.name for r in self._list]
-            config.global_option('repolist').setValue(repolist)
+            self._update()
             config.unregister_repo(repository.name)
 
+    def reindex(self):
+        ''' Rebuild indexes after channel or configuration changes. '''
+        with self._lock:
+            self._reindex()
+
     def get(self):
         ''' Return copy of the repository list. '''
         with self._lock:
             return list(self._list)
 
+    def by_channel(self, channel):
+        ''' Return list of repositories configured for channel. '''
+        with self._lock:
+            return list(self._by_channel.get(channel, []))
+
+    def snarfers(self, channel):
+        ''' Return list of snarf-enabled repositories for channel. '''
+        with self._lock:
+            return list(self._snarf_by_channel.get(channel, []))
+
+    def targets(self, repository):
+        ''' Return list of joined (irc, channel) to notify for repository. '''
+        with self._lock:
+            return list(self._targets.get(repository.name, []))
+
+
+class _Workers(object):
+    '''
+    A fixed number of daemon threads running submitted jobs in order, or
+    lowest priority first if prioritized. The threads are started by the
+    first submit(), and stopped by stop() when the jobs already queued are
+    done.
+    '''
+
+    def __init__(self, name, count, prioritized=False):
+        self.log = log.getPluginLogger('git.' + name)
+        self._name = name
+        self._count = count
+        self._queue = Queue.PriorityQueue() if prioritized else Queue.Queue()
+        self._seq = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _run(self):
+        ''' Thread body: run jobs until stopped. '''
+        while True:
+            priority, seq, job = self._queue.get()
+            if job is None:
+                break
+            func, args = job
+            try:
+                func(*args)
+            except Exception:                  # pylint: disable=W0703
+                self.log.exception("Error in %s job" % self._name)
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Queue func(*args) to be run by a worker thread. If prioritized,
+        a lower priority keyword argument (default 0) runs earlier.
+        '''
+        priority = kwargs.get('priority', 0)
+        with self._lock:
+            if not self._threads:
+                for i in range(self._count):
+                    t = threading.Thread(target=self._run,
+                                         name='git-%s-%d' % (self._name, i))
+                    t.setDaemon(True)
+                    t.start()
+                    self._threads.append(t)
+            self._queue.put((priority, next(self._seq), (func, args)))
+
+    def pending(self):
+        ''' Return approximate number of jobs not yet started. '''
+        return self._queue.qsize()
+
+    def stop(self):
+        ''' Let threads exit after running all jobs already queued. '''
+        with self._lock:
+            for t in self._threads:
+                self._queue.put((sys.maxint, next(self._seq), None))
+            self._threads = []
+
+
+def _next_interval(interval, changed, low, high):
+    '''
+    Return the fetch interval to use after a fetch which used interval:
+    halved if the remote changed, else 50 % longer, within [low, high].
+    Never below 1 s, which would fetch back to back.
+    '''
+    interval = interval / 2.0 if changed else interval * 1.5
+    low = max(low, 1)
+    return min(max(interval, low), max(low, high))
+
 
 class _GitFetcher(threading.Thread):
     """
     Thread replicating remote data to local repos roughly using git pull and
-    git fetch. When done schedules a callback call and exits.
+    git fetch. Each repository has its own due time, kept in a heap. After
+    a fetch the repository's interval is adapted to how often it changes
+    and the poll callback is scheduled for it. Runs until stopped.
     """
 
+    IDLE_WAIT = 60
+    # Delay of fetches due while the repository is maintained.
+    MAINTENANCE_WAIT = 30
+
     def __init__(self, repos, fetch_done_cb):
         self.log = log.getPluginLogger('git.fetcher')
         threading.Thread.__init__(self)
         self._shutdown = False
         self._repos = repos
         self._callback = fetch_done_cb
+        self._due = []                 # heap of (due time, repo name)
+        self._intervals = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
 
     def stop(self):
         """
-        Shut down the thread as soon as possible. May take some time if
-        inside a long-running fetch operation.
+        Shut down the thread after the current fetch, if any. May take
+        some time if inside a long-running fetch operation.
         """
         self._shutdown = True
+        self._wakeup.set()
 
-    def run(self):
+    def wakeup(self):
+        ''' Make thread look for added or removed repositories now. '''
+        self._wakeup.set()
+
+    def due(self, name):
+        ''' Return (next fetch time, interval) for repo name, or None. '''
+        with self._lock:
+            if name not in self._intervals:
+                return None
+            times = [when for when, n in self._due if n == name]
+            return (min(times) if times else time.time(),
+                    self._intervals[name])
+
+    def _sync(self, by_name):
+        ''' Schedule added repositories right away, forget removed. '''
+        now = time.time()
+        with self._lock:
+            for name in by_name:
+                if name not in self._intervals:
+                    self._intervals[name] = \
+                        config.global_option('pollPeriod').value
+                    heapq.heappush(self._due, (now, name))
+            for name in self._intervals.keys():
+                if name not in by_name:
+                    del self._intervals[name]
+
+    def _fetch(self, repository):
+        '''
+        Fetch repository unless refused by its circuit breakers, schedule
+        poll and next fetch. A repository being maintained is retried
+        after MAINTENANCE_WAIT.
+        '''
+        if not _BREAKERS.allow(repository):
+            with self._lock:
+                if repository.name in self._intervals:
+                    heapq.heappush(self._due,
+                                   (_BREAKERS.retry_at(repository) + 1,
+                                    repository.name))
+            return
+        if repository.maintaining:
+            # Don't block other repositories waiting for maintenance.
+            with self._lock:
+                if repository.name in self._intervals:
+                    heapq.heappush(self._due,
+                                   (time.time() + self.MAINTENANCE_WAIT,
+                                    repository.name))
+            return
         start = time.time()
+        changed = None
+        scheduled = False
+        _MEMORY.begin(repository.name)
+        trace = _TRACER.begin(repository.name)
+        try:
+            with _TRACER.activate(trace):
+                with _TRACER.span('repo fetch') as span:
+                    try:
+                        changed = repository.fetch_once()
+                    except git.GitCommandError as e:
+                        # Logged by the breakers.
+                        self.log.debug("Error in git command: " + str(e))
+                    except Exception as e:          # pylint: disable=W0703
+                        self.log.error("Cannot fetch %s: %s" %
+                                       (repository.name, str(e)),
+                                       exc_info=True)
+                    span['changed'] = changed
+            with self._lock:
+                if repository.name not in self._intervals:
+                    return
+                interval = _next_interval(
+                    self._intervals[repository.name], changed,
+                    config.global_option('minPollPeriod').value,
+                    config.global_option('maxPollPeriod').value)
+                self._intervals[repository.name] = interval
+                heapq.heappush(self._due, (time.time() + interval,
+                                           repository.name))
+            if trace:
+                trace['queued'] = time.time()
+            _Scheduler.run_callback(
+                lambda: self._callback([repository], trace),
+                'fetch_callback-' + repository.name)
+            scheduled = True
+        finally:
+            if not scheduled:
+                _MEMORY.end(repository)
+                _TRACER.end(trace)
+        self.log.debug("Fetched %s in %.2f s, next in %d s" %
+                       (repository.name, time.time() - start, interval))
+
+    def run(self):
+        while not self._shutdown:
+            if not config.global_option('pollPeriod').value:
+                self._wakeup.wait(self.IDLE_WAIT)
+                self._wakeup.clear()
+                continue
+            by_name = dict([(r.name, r) for r in self._repos.get()])
+            self._sync(by_name)
+            with self._lock:
+                now = time.time()
+                if self._due and self._due[0][0] <= now:
+                    when, name = heapq.heappop(self._due)
+                    repository = by_name.get(name)
+                    wait = 0
+                else:
+                    repository = None
+                    wait = self._due[0][0] - now if self._due \
+                        else self.IDLE_WAIT
+            if repository:
+                self._fetch(repository)
+            elif wait:
+                self._wakeup.wait(wait)
+                self._wakeup.clear()
+        self.log.debug("Exiting fetcher thread")
+
+
+class _Maintainer(threading.Thread):
+    """
+    Thread running maintain() on repositories not maintained during the
+    last maintenancePeriod, one at a time. Repositories being fetched are
+    skipped until next run. Exits when done.
+    """
+
+    def __init__(self, repos):
+        self.log = log.getPluginLogger('git.maintainer')
+        threading.Thread.__init__(self)
+        self._shutdown = False
+        self._repos = repos
+
+    def stop(self):
+        ''' Exit after the current repository. '''
+        self._shutdown = True
+
+    def run(self):
+        period = config.global_option('maintenancePeriod').value
         for repository in self._repos.get():
             if self._shutdown:
                 break
+            if repository.maintained and \
+                    time.time() - repository.maintained[0] < period:
+                continue
             try:
-                with repository.lock:
-                    repository.fetch()
+                if not repository.maintain():
+                    self.log.debug("Busy or following, not maintaining " +
+                                   repository.name)
             except git.GitCommandError as e:
                 self.log.error("Error in git command: " + str(e),
-                                   exc_info=True)
-        _Scheduler.run_callback(self._callback, 'fetch_callback')
-        self.log.debug("Exiting fetcher thread, elapsed: " +
-                       str(time.time() - start))
+                               exc_info=True)
 
 
 class _DisplayCtx(object):
-    ''' Simple container for displaying commits stuff. '''
+    '''
+    Simple container for displaying commits stuff. channel is a channel
+    name or a list of them, each line is sent to all using as few
+    messages as the server allows.
+    '''
     SNARF = 'snarf'
     REPOLOG = 'repolog'
+    SEARCH = 'search'
     COMMITS = 'commits'
 
     def __init__(self, irc, channel, repository, kind=None):
         self.irc = irc
-        self.channel = channel
+        self.channels = channel if isinstance(channel, list) else [channel]
         self.repo = repository
         self.kind = kind if kind else self.COMMITS
 
+    def _send(self, line):
+        ''' Queue messages sending line to all channels. '''
+        for msg in _privmsgs(self.irc, self.channels, line):
+            self.irc.queueMsg(msg)
+
     _use_group_header = property(lambda self:
-        self.repo.options.group_header and self.kind != self.REPOLOG)
+        self.repo.options.group_header and
+            self.kind not in [self.REPOLOG, self.SEARCH])
 
     def _display_some_commits(self, commits, branch):
         "Display a nicely-formatted list of commits for an author/branch."
         for commit in commits:
             lines = _format_message(self, commit, branch)
             for line in lines:
-                msg = ircmsgs.privmsg(self.channel, line)
-                self.irc.queueMsg(msg)
+                self._send(line)
 
     def _get_limited_commits(self, commits_by_branch):
         "Return the topmost commits which are OK to display."
@@ -436,12 +2494,11 @@ class _DisplayCtx(object):
         top_commits = sorted(top_commits, key = lambda c: c.committed_date)
         commits_at_once = config.global_option('maxCommitsAtOnce').value
         if len(top_commits) > commits_at_once:
-            self.irc.queueMsg(ircmsgs.privmsg(self.channel,
-                             "Showing latest %d of %d commits to %s..." % (
-                             commits_at_once,
-                             len(top_commits),
-                             self.repo.name,
-                             )))
+            self._send("Showing latest %d of %d commits to %s..." % (
+                       commits_at_once,
+                       len(top_commits),
+                       self.repo.name,
+                       ))
         top_commits = top_commits[-commits_at_once:]
         return top_commits
 
@@ -453,16 +2510,56 @@ class _DisplayCtx(object):
         else:
             return self.repo.options.commit_msg
 
+    def display_branch_events(self, events):
+        "Display list of ('created'|'deleted', branch) tuples."
+        for what, branch in events:
+            line = "Branch %s %s at %s" % (branch, what, self.repo.name)
+            self._send(line)
+
+    def display_tag_events(self, events):
+        '''
+        Display list of ('created'|'moved'|'deleted', tag, summary) tuples,
+        at most maxCommitsAtOnce.
+        '''
+        at_once = config.global_option('maxCommitsAtOnce').value
+        if len(events) > at_once:
+            self._send("Showing latest %d of %d tag changes at %s..." % (
+                       at_once, len(events), self.repo.name))
+        for what, tag, summary in events[-at_once:] if at_once else []:
+            if what == 'deleted':
+                self._send("Tag %s deleted at %s" % (tag, self.repo.name))
+                continue
+            for line in _format_message(self, summary, tag=(tag, what)):
+                self._send(line)
+
+    def display_digest(self, digest):
+        '''
+        Display a get_digest() list: a line per branch with commit counts
+        by author, followed by the first and last commit.
+        '''
+        for branch, count, authors, first, last in digest:
+            names = ', '.join(['%s (%d)' % (name, n)
+                                  for n, name in authors[:5]])
+            if len(authors) > 5:
+                names += ' and %d more' % (len(authors) - 5)
+            self._send("Catching up: %d commit(s) to %s at %s by %s" % (
+                       count, branch, self.repo.name, names.encode('utf-8')))
+            commits = [first, last] if count > 1 else [last]
+            self._display_some_commits(commits, branch)
+
     def display_commits(self, commits_by_branch):
         "Display a nicely-formatted list of commits in a channel."
 
         if not commits_by_branch:
             return
         top_commits = self._get_limited_commits(commits_by_branch)
+        if _DIFFSTAT_RE.search(self.format):
+            # Compute any stats not prepared by the fetch at once.
+            self.repo.diffstats([c.hexsha for c in top_commits])
         for branch, all_commits in commits_by_branch.iteritems():
-            for a in set([c.author.name for c in all_commits]):
+            for a in set([c.author_name for c in all_commits]):
                 commits = [c for c in all_commits
-                               if c.author.name == a and c in top_commits]
+                               if c.author_name == a and c in top_commits]
                 if not self._use_group_header:
                     self._display_some_commits(commits, branch)
                     continue
@@ -472,8 +2569,7 @@ class _DisplayCtx(object):
                     name = self.repo.name
                     line = "%s pushed %d commit(s) to %s at %s" % (
                         a, len(commits), branch, name)
-                msg = ircmsgs.privmsg(self.channel, line)
-                self.irc.queueMsg(msg)
+                self._send(line)
                 self._display_some_commits(commits, branch)
 
 
@@ -481,14 +2577,21 @@ class _Scheduler(object):
     '''
     Handles scheduling of fetch and poll tasks.
 
-    Polling happens in three steps:
-     -  reset()  kills all active jobs  and schedules
-        start_fetch to be invoked periodically.
-     -  start_fetch() fires off the one-shot GitFetcher
-        thread which handles the long-running git replication.
-     -  When done, the GitFetcher thread invokes Scheduler.run_callback.
-        This invokes poll_all_repos in main thread but this is quick,
-        (almost) no remote IO is needed.
+    Interactive requests to fetch a repository are handled by the urgent
+    queue, ahead of and in parallel with the periodic fetches, see
+    fetch_now().
+
+    Repository maintenance is checked hourly by a one-shot _Maintainer
+    thread, see maintenancePeriod.
+
+    Polling happens in two steps:
+     -  reset() starts the GitFetcher thread unless running. It handles
+        the long-running git replication, fetching each repository when
+        due.
+     -  After each fetch, the GitFetcher thread invokes
+        Scheduler.run_callback. This invokes poll_all_repos for the
+        repository in main thread but this is quick, (almost) no remote
+        IO is needed.
     '''
 
     def __init__(self, repos, fetch_done_cb):
@@ -496,30 +2599,46 @@ class _Scheduler(object):
         self._repos = repos
         self.log = log.getPluginLogger('git.conf')
         self.fetcher = None
+        self.maintainer = None
+        self.urgent = _Workers('urgent', 1, prioritized=True)
+        self._callback_ids = itertools.count()
         self.reset()
 
     fetching_alive = \
         property(lambda self: self.fetcher and self.fetcher.is_alive())
 
+    maintaining_alive = \
+        property(lambda self: self.maintainer and self.maintainer.is_alive())
+
+    MAINTENANCE_CHECK = 3600
+
+    INTERACTIVE = 0
+
     def reset(self, die=False):
         '''
-        Revoke scheduled events, start a new fetch right now unless
-        die or testing.
+        Revoke scheduled events, start the fetcher thread unless running,
+        die or testing. A running fetcher is never interrupted.
         '''
         try:
-            schedule.removeEvent('repofetch')
+            schedule.removeEvent('repomaintain')
         except KeyError:
             pass
         if die or world.testing:
             return
+        if config.global_option('maintenancePeriod').value:
+            schedule.addPeriodicEvent(
+                lambda: _Scheduler.start_maintenance(self),
+                self.MAINTENANCE_CHECK, 'repomaintain', False)
         pollPeriod = config.global_option('pollPeriod').value
         if not pollPeriod:
             self.log.debug("Scheduling: ignoring reset with pollPeriod 0")
             return
-        schedule.addPeriodicEvent(lambda: _Scheduler.start_fetch(self),
-                                  pollPeriod,
-                                 'repofetch',
-                                  not self.fetching_alive)
+        if self.fetching_alive:
+            self.fetcher.wakeup()
+            return
+        self.fetcher = _GitFetcher(self._repos, self._fetch_done_cb)
+        self.fetcher.setDaemon(True)
+        self.fetcher.start()
         self.log.debug("Restarted polling")
 
     def stop(self):
@@ -535,19 +2654,53 @@ class _Scheduler(object):
             except Exception, e:
                 self.log.error('Stopping fetcher: %s' % str(e),
                                exc_info=True)
+        self.urgent.stop()
+        if self.maintaining_alive:
+            try:
+                self.maintainer.stop()
+                self.maintainer.join()
+            except Exception, e:
+                self.log.error('Stopping maintainer: %s' % str(e),
+                               exc_info=True)
         self.reset(die = True)
 
-    def start_fetch(self):
-        ''' Start next GitFetcher run. '''
-        if not config.global_option('pollPeriod').value:
+    def fetch_now(self, repository, done_cb, priority=INTERACTIVE):
+        '''
+        Queue a fetch of repository on the urgent queue, then invoke
+        done_cb(seconds, error) on main thread, error being None or an
+        exception. A fetch already in progress is awaited, not repeated.
+        '''
+
+        def job(direct=False):
+            ''' Fetch, hand over result to main thread. '''
+            start = time.time()
+            try:
+                repository.fetch_once()
+                error = None
+            except Exception as e:                  # pylint: disable=W0703
+                error = e
+            todo = lambda: done_cb(time.time() - start, error)
+            if direct:
+                todo()
+            else:
+                _Scheduler.run_callback(
+                    todo, 'urgentfetch-%d' % next(self._callback_ids))
+
+        if world.testing:
+            job(direct=True)
+        else:
+            self.urgent.submit(job, priority=priority)
+
+    def start_maintenance(self):
+        ''' Start a _Maintainer run unless one is still running. '''
+        if not config.global_option('maintenancePeriod').value:
             return
-        if self.fetching_alive:
-            self.log.error("Fetcher running when about to start!")
-            self.fetcher.stop()
-            self.fetcher.join()
-            self.log.info("Stopped fetcher")
-        self.fetcher = _GitFetcher(self._repos, self._fetch_done_cb)
-        self.fetcher.start()
+        if self.maintaining_alive:
+            self.log.debug("Maintainer still running, skipping")
+            return
+        self.maintainer = _Maintainer(self._repos)
+        self.maintainer.setDaemon(True)
+        self.maintainer.start()
 
     @staticmethod
     def run_callback(callback, id_):
@@ -568,13 +2721,72 @@ class Git(callbacks.PluginRegexp):
 
     def __init__(self, irc):
         callbacks.PluginRegexp.__init__(self, irc)
+        self._snarfed = _ExpiringSet()
+        self._snarfed_msg = None
         self.repos = _Repos()
-        fetch_done_cb = lambda: _poll_all_repos(self.repos.get())
+        self._cloners = _Workers('clone',
+                                 config.global_option('cloneWorkers').value)
+        self._deleter = _Workers('delete', 1)
+        self._cloning = set()
+        self._cloning_lock = threading.Lock()
+        self._delete_trash()
+        config.add_listener(self._option_changed)
+        fetch_done_cb = self._fetch_done
         self.scheduler = _Scheduler(self.repos, fetch_done_cb)
         if hasattr(irc, 'reply'):
             n = len(self.repos.get())
             irc.reply('Git reinitialized with %s.' % nItems(n, 'repository'))
 
+    def _fetch_done(self, repolist, trace=None):
+        ''' Poll repositories after periodic fetch, ending the cycle. '''
+        if trace:
+            _TRACER.emit(trace, 'queue', trace['queued'], time.time())
+        try:
+            with _TRACER.activate(trace):
+                _poll_all_repos(self.repos, repolist)
+        finally:
+            for repository in repolist:
+                _MEMORY.end(repository)
+            _TRACER.end(trace)
+
+    def _reserve_clone(self, reponame):
+        ''' Mark reponame as being cloned, False if it already is. '''
+        with self._cloning_lock:
+            if reponame in self._cloning:
+                return False
+            self._cloning.add(reponame)
+            return True
+
+    def _clone(self, reponame, opts, cloning_done_cb):
+        '''
+        Register opts for reponame reserved by _reserve_clone() and clone
+        it using the clone workers. The registry and repository list are
+        only modified on main thread, where cloning_done_cb is invoked
+        with a _Repository or an error msg.
+        '''
+
+        def done(result):
+            ''' Release reponame, drop its options if not cloned. '''
+            with self._cloning_lock:
+                self._cloning.discard(reponame)
+            if not isinstance(result, _Repository):
+                config.unregister_repo(reponame)
+            cloning_done_cb(result)
+
+        def start():
+            ''' Register options and submit the clone. '''
+            for key, value in opts.iteritems():
+                config.repo_option(reponame, key).setValue(value)
+            if world.testing:
+                _Repository.create(reponame, done)
+            else:
+                self._cloners.submit(_Repository.create, reponame, done)
+
+        if world.testing:
+            start()
+        else:
+            _Scheduler.run_callback(start, 'clonestart-' + reponame)
+
     def _parse_repo(self, irc, msg, repo, channel):
         """ Parse first parameter as a repo, return repository or None. """
         matches = filter(lambda r: r.name == repo, self.repos.get())
@@ -586,34 +2798,94 @@ class Git(callbacks.PluginRegexp):
         # Enforce a modest privacy measure... don't let people probe the
         # repository outside the designated channel.
         repository = matches[0]
-        if channel not in repository.options.channels:
+        if not [c for c in repository.options.channels
+                if ircutils.strEqual(c, channel)]:
             irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Sorry, not allowed in this channel.'))
             return None
         return repository
 
+    def do001(self, irc, msg):
+        ''' (Re)connected: channels are gone until joined again. '''
+        self.repos.reindex()
+
+    def doJoin(self, irc, msg):
+        ''' Update routing indexes when joining a channel. '''
+        if ircutils.strEqual(msg.nick, irc.nick):
+            self.repos.reindex()
+
+    def doPart(self, irc, msg):
+        ''' Update routing indexes when leaving a channel. '''
+        if ircutils.strEqual(msg.nick, irc.nick):
+            self.repos.reindex()
+
+    def doKick(self, irc, msg):
+        ''' Update routing indexes when kicked from a channel. '''
+        if irc.nick in msg.args[1].split(','):
+            self.repos.reindex()
+
+    def _option_changed(self, reponame, option):
+        ''' Registry listener: apply a repository option in place. '''
+        for repository in self.repos.get():
+            if repository.name == reponame:
+                break
+        else:
+            return
+        repository.reconfigure(option)
+        if option in ['channels', 'enableSnarf']:
+            self.repos.reindex()
+        self.log.debug("Applied %s change for %s" % (option, reponame))
+
+    def _delete_trash(self):
+        ''' Queue removal of clones left behind by an interrupted repokill. '''
+        repo_dir = config.global_option('repoDir').value
+        if not os.path.isdir(repo_dir):
+            return
+        for name in os.listdir(repo_dir):
+            if name.startswith('.deleted-'):
+                self._deleter.submit(shutil.rmtree,
+                                     os.path.join(repo_dir, name), True)
+
     def die(self):
-        ''' Stop all threads.  '''
+        ''' Stop all threads, give up leadership of shared clones.  '''
+        config.remove_listener(self._option_changed)
         self.scheduler.stop()
+        for repository in self.repos.get():
+            if repository.shared:
+                repository.shared.release()
+        self._cloners.stop()
+        self._deleter.stop()
         callbacks.PluginRegexp.die(self)
 
     def snarf_sha(self, irc, msg, match):
         r"""\b(?P<sha>[0-9a-f]{6,40})\b"""
         # docstring (ab)used for plugin introspection. Called by
-        # framework if string matching regexp above is found in chat.
-        sha = match.group('sha')
+        # framework for each string matching regexp above found in chat.
+        # All shas in the line are handled on the first call.
+        if msg is self._snarfed_msg:
+            return
+        self._snarfed_msg = msg
         channel = msg.args[0]
-        repositories = [r for r in self.repos.get()
-                            if channel in r.options.channels]
+        repositories = self.repos.snarfers(channel)
+        if not repositories:
+            return
+        shas = []
+        for m in match.re.finditer(msg.args[1]):
+            if m.group('sha') not in shas:
+                shas.append(m.group('sha'))
+        window = config.global_option('snarfDedupWindow').value
         for repository in repositories:
-            if not repository.options.enable_snarf:
-                continue
-            try:
-                commit = repository.get_commit(sha)
-            except git.exc.BadObject:
-                continue
-            ctx = _DisplayCtx(irc, channel, repository, _DisplayCtx.SNARF)
-            ctx.display_commits({'unknown': [commit]})
-            break
+            if not shas:
+                break
+            found = repository.lookup(shas)
+            for sha in [s for s in shas if s in found]:
+                shas.remove(sha)
+                commit = found[sha]
+                key = (channel, commit.hexsha)
+                if window and not self._snarfed.add(key, window):
+                    continue
+                ctx = _DisplayCtx(irc, channel, repository,
+                                  _DisplayCtx.SNARF)
+                ctx.display_commits({'unknown': [commit]})
 
     def repolog(self, irc, msg, args, channel, repo, branch, count):
         """ repo [branch [count]]
@@ -630,12 +2902,11 @@ class Git(callbacks.PluginRegexp):
                           ', '.join(repository.branches)))
             return
         try:
-            branch_head = repository.get_commit(branch)
+            commits = repository.get_recent_commits(branch, count)[::-1]
         except git.GitCommandError:
             self.log.info("Cant get branch commit", exc_info=True)
             irc.sendMsg(ircmsgs.privmsg(msg.args[0],"Internal error retrieving repolog data"))
             return
-        commits = repository.get_recent_commits(branch_head, count)[::-1]
         ctx = _DisplayCtx(irc, channel, repository, _DisplayCtx.REPOLOG)
         ctx.display_commits({branch: commits})
 
@@ -644,13 +2915,49 @@ class Git(callbacks.PluginRegexp):
                              optional('somethingWithoutSpaces', 'master'),
                              optional('positiveInt', 1)])
 
+    def gitsearch(self, irc, msg, args, channel, repo, text):
+        """ <repository name> <terms>
+
+        Search commit messages in a repository. All words must match.
+        author:<name or email> limits to an author, since:<date> and
+        until:<date> to a time span where date is YYYY-MM-DD, Nd (N days
+        ago) or Nw (N weeks ago). Requires the commitCatalog option.
+        """
+        repository = self._parse_repo(irc, msg, repo, channel)
+        if not repository:
+            return
+        if not repository.catalog:
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                'Search requires the commitCatalog option for ' + repo))
+            return
+        try:
+            query = _parse_search(text)
+        except ValueError as e:
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0], 'Error: ' + str(e)))
+            return
+        limit = config.global_option('maxCommitsAtOnce').value
+        total, hits = repository.catalog.search(*query, limit=limit)
+        if not hits:
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0], 'No matching commits'))
+            return
+        if total > len(hits):
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                "Showing latest %d of %d matches in %s..." % (
+                    len(hits), total, repo)))
+        commits_by_branch = {}
+        for branch, commit in hits:
+            commits_by_branch.setdefault(branch, []).append(commit)
+        ctx = _DisplayCtx(irc, channel, repository, _DisplayCtx.SEARCH)
+        ctx.display_commits(commits_by_branch)
+
+    gitsearch = wrap(gitsearch, ['channel', 'somethingWithoutSpaces', 'text'])
+
     def repolist(self, irc, msg, args, channel):
         """(takes no arguments)
 
         Display the names of known repositories configured for this channel.
         """
-        repositories = filter(lambda r: channel in r.options.channels,
-                              self.repos.get())
+        repositories = self.repos.by_channel(channel)
         if not repositories:
             irc.sendMsg(ircmsgs.privmsg(msg.args[0],'No repositories configured for this channel.'))
             return
@@ -673,6 +2980,23 @@ class Git(callbacks.PluginRegexp):
         if not repository:
             return
         irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Watched branches: ' + ', '.join(repository.branches)))
+        due = self.scheduler.fetching_alive and \
+            self.scheduler.fetcher.due(repository.name)
+        if due:
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                'Next fetch in %d s, interval %d s' %
+                    (max(0, due[0] - time.time()), due[1])))
+        for line in _BREAKERS.troubles(repository):
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0], 'Fetch: ' + line))
+        if repository.maintained:
+            when, before, after = repository.maintained
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(when))
+            if before is None:
+                line = 'Maintenance failed %s' % when
+            else:
+                line = 'Maintained %s, rev walk %.1f ms before, ' \
+                       '%.1f ms after' % (when, before, after)
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0], line))
 
     repostat = wrap(repostat, ['channel', 'somethingWithoutSpaces'])
 
@@ -681,11 +3005,64 @@ class Git(callbacks.PluginRegexp):
 
         Display overall common configuration for all repositories.
         """
-        for option in ['maxCommitsAtOnce', 'pollPeriod', 'repoDir']:
+        for option in ['maxCommitsAtOnce', 'pollPeriod', 'repoDir',
+                       'maintenancePeriod']:
             irc.sendMsg(ircmsgs.privmsg(msg.args[0],option + ': ' + str(config.global_option(option))))
 
     gitconf = wrap(gitconf, [])
 
+    def gitmetrics(self, irc, msg, args):
+        """ Takes no arguments
+
+        Display resource usage: open repository handles, file
+        descriptors and memory.
+        """
+        stats = _HANDLES.stats()
+        fds, rss = _process_stats()
+        irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+            'Repository handles: %(open)d open of max %(size)d,'
+            ' %(hits)d hits, %(opened)d opened, %(evicted)d evicted' % stats))
+        irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+            'Process: %s open files, %s kB resident' % (fds, rss)))
+        irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+            'Queued jobs: %d clone, %d delete' %
+                (self._cloners.pending(), self._deleter.pending())))
+        troubles = _BREAKERS.troubles()
+        irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+            'Fetch breakers: ' + ('; '.join(troubles) if troubles
+                                  else 'all closed')))
+
+    gitmetrics = wrap(gitmetrics, ['owner'])
+
+    def gitmem(self, irc, msg, args):
+        """ Takes no arguments
+
+        Display memory diagnostics: resident size trend, the largest growth
+        in the last sampled fetch/poll cycle and the objects retained by
+        each repository. See memorySampleRate.
+        """
+        send = lambda line: irc.sendMsg(ircmsgs.privmsg(msg.args[0], line))
+        rss = list(_MEMORY.rss)
+        if rss:
+            hours = (rss[-1][0] - rss[0][0]) / 3600
+            send('RSS: %d kB, %+d kB during %.1f h: %s' % (
+                rss[-1][1], rss[-1][1] - rss[0][1], hours,
+                ' '.join([str(kb) for when, kb in rss[-8:]])))
+        else:
+            send('RSS: no fetch/poll cycle done yet')
+        if not _MEMORY.growth:
+            send('No sampled cycle yet, memorySampleRate is %s' %
+                 config.global_option('memorySampleRate').value)
+            return
+        name, types = _MEMORY.growth
+        send('Growth in last sampled cycle (%s): %s' % (name, ', '.join(
+            ['%s %+d' % item for item in types]) or 'none'))
+        retained = sorted(_MEMORY.retained.items(), key=lambda i: -i[1])
+        send('Retained objects: ' + ', '.join(
+            ['%s %d' % item for item in retained[:_MEMORY.TOP]]))
+
+    gitmem = wrap(gitmem, ['owner'])
+
     def repoconf(self, irc, msg, args, channel, repo):
         """ <repository name>
 
@@ -708,20 +3085,35 @@ class Git(callbacks.PluginRegexp):
     def repopoll(self, irc, msg, args, channel, repo):
         """ [repository name]
 
-        Poll a named repository, or all if none given.
+        Fetch and poll a named repository right away, or poll the already
+        fetched data of all if none given.
         """
-        if repo:
-            repository = self._parse_repo(irc, msg, repo, channel)
-            if not repository:
+        if not repo:
+            try:
+                _poll_all_repos(self.repos, self.repos.get(), throw = True)
+                irc.replySuccess()
+            except Exception as e:              # pylint: disable=W0703
+                irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Error: ' + str(e)))
+            return
+        repository = self._parse_repo(irc, msg, repo, channel)
+        if not repository:
+            return
+
+        def fetch_done_cb(fetch_time, error):
+            ''' Poll and report timing when fetched. '''
+            start = time.time()
+            try:
+                if error:
+                    raise error
+                _poll_all_repos(self.repos, [repository], throw = True)
+            except Exception as e:              # pylint: disable=W0703
+                irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Error: ' + str(e)))
                 return
-            repos = [repository]
-        else:
-            repos = self.repos.get()
-        try:
-            _poll_all_repos(repos, throw = True)
-            irc.replySuccess()
-        except Exception as e:              # pylint: disable=W0703
-            irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Error: ' + str(e)))
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                'Fetched %s in %.2f s, polled in %.2f s' %
+                    (repository.name, fetch_time, time.time() - start)))
+
+        self.scheduler.fetch_now(repository, fetch_done_cb)
 
     repopoll = wrap(repopoll, ['owner',
                                'channel',
@@ -755,14 +3147,15 @@ class Git(callbacks.PluginRegexp):
         if reponame in config.global_option('repolist').value:
             irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Error: repo exists'))
             return
+        if not self._reserve_clone(reponame):
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                        'Error: %s is already being cloned' % reponame))
+            return
         opts = {'url': url, 'channels': channels}
+        self._clone(reponame, opts, cloning_done_cb)
         if world.testing:
-            _Repository.create(reponame, cloning_done_cb, opts)
             irc.sendMsg(ircmsgs.privmsg(msg.args[0],"Repository created and cloned"))
             return
-        t = threading.Thread(target = _Repository.create,
-                             args = (reponame, cloning_done_cb, opts))
-        t.start()
         irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Cloning of %s started...' % reponame))
 
     repoadd = wrap(repoadd, ['owner',
@@ -771,17 +3164,106 @@ class Git(callbacks.PluginRegexp):
                              'somethingWithoutSpaces',
                              commalist('validChannel')])
 
+    def repoimport(self, irc, msg, args, channel, path):
+        """ <manifest file>
+
+        Add and clone all repositories listed in a file, one per line as
+        <name> <url> <channel[,channel...]>. Empty lines and lines starting
+        with # are ignored.
+        """
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except IOError as e:
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                        'Error: Cannot read manifest: ' + str(e)))
+            return
+        existing = config.global_option('repolist').value
+        todo = []
+        for lineno, line in enumerate(lines, 1):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            channels = words[2].split(',') if len(words) == 3 else []
+            if not channels or \
+                    not all([ircutils.isChannel(c) for c in channels]):
+                irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                            'Error: Bad manifest line %d: %s' %
+                                (lineno, line.strip())))
+                return
+            if words[0] in existing or words[0] in [t[0] for t in todo]:
+                irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                            'Skipping existing repo ' + words[0]))
+                continue
+            todo.append((words[0], {'url': words[1], 'channels': channels}))
+        for reponame, opts in list(todo):
+            if not self._reserve_clone(reponame):
+                irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                            'Skipping repo being cloned ' + reponame))
+                todo.remove((reponame, opts))
+        if not todo:
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0], 'Nothing to import'))
+            return
+        progress = {'done': 0, 'failed': []}
+        step = max(1, len(todo) // 10)
+
+        def cloning_done_cb(reponame, result):
+            ''' Callback invoked on main thread after each clone. '''
+            progress['done'] += 1
+            if isinstance(result, _Repository):
+                self.repos.append(result)
+            else:
+                progress['failed'].append(reponame)
+                self.log.info("Cannot clone %s: %s" % (reponame, result))
+            done = progress['done']
+            if done == len(todo):
+                line = 'Import done: %d of %d repositories cloned' % (
+                    done - len(progress['failed']), done)
+                if progress['failed']:
+                    line += ', failed: ' + ', '.join(progress['failed'])
+            elif done % step == 0:
+                line = 'Imported %d of %d repositories' % (done, len(todo))
+            else:
+                return
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0], line))
+
+        irc.sendMsg(ircmsgs.privmsg(msg.args[0],
+                    'Cloning %s...' % nItems(len(todo), 'repository')))
+        for reponame, opts in todo:
+            callback = lambda result, name=reponame: \
+                cloning_done_cb(name, result)
+            self._clone(reponame, opts, callback)
+
+    repoimport = wrap(repoimport, ['owner', 'channel', 'filename'])
+
     def repokill(self, irc, msg, args, channel, reponame):
         """ <repository name>
 
-        Removes an existing repository given it's name.
+        Removes an existing repository given it's name. The local clone
+        is deleted in the background.
         """
         found_repos = [r for r in self.repos.get() if r.name == reponame]
         if not found_repos:
             irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Error: repo does not exist'))
             return
-        self.repos.remove(found_repos[0])
-        shutil.rmtree(found_repos[0].path)
+        repository = found_repos[0]
+        self.repos.remove(repository)
+        _HANDLES.discard(repository.path)
+        _BREAKERS.discard(repository)
+        _MEMORY.forget(repository.name)
+        if repository.shared:
+            # Other bots may use the clone, just leave it.
+            repository.shared.release()
+            irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Repository deleted'))
+            return
+        # Renaming is instant, the slow rmtree runs on the deleter thread.
+        trash = os.path.join(os.path.dirname(repository.path),
+                             '.deleted-%s-%d' % (reponame, time.time()))
+        try:
+            os.rename(repository.path, trash)
+            self._deleter.submit(shutil.rmtree, trash, True)
+        except OSError as e:
+            self.log.warning("Cannot remove %s: %s" % (repository.path, e))
         irc.sendMsg(ircmsgs.privmsg(msg.args[0],'Repository deleted'))
 
     repokill = wrap(repokill,
@@ -40,7 +40,14 @@ from supybot.test import *
 from supybot import conf
 
 import git
+import json
 import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 
 SRC_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -265,6 +272,217 @@ class GitLogTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponses('What about cbe46d8?', expected,
                              usePrefixChar=False)
 
+    def testChannelCase(self):
+        option = conf.supybot.plugins.Git.repos.test2.channels
+        option.setValue(['#TEST'])
+        try:
+            self.assertResponse('repolog test2 feature',
+                                '[test2|feature|Tyrion Lannister] '
+                                    'Snarks and grumpkins')
+            self.assertResponses('What about cbe46d8?', [
+                "Talking about cbe46d8?",
+                "I. e., [test2|Tyrion Lannister]"
+                    " I am the only one getting things done",
+            ], usePrefixChar=False)
+        finally:
+            option.setValue(['#test'])
+
+    def testHandlePool(self):
+        conf.supybot.plugins.Git.maxOpenRepos.setValue(1)
+        # Make repolog read git instead of the recent commit buffer.
+        for repository in self.irc.getCallback('Git').repos.get():
+            repository.recent.clear()
+        try:
+            expected = ['[test2|feature|Tyrion Lannister] '
+                            'Snarks and grumpkins']
+            self.assertResponses('repolog test2 feature', expected)
+            self.assertRegexp('gitmetrics',
+                              'Repository handles: 1 open of max 1')
+            self.getMsg(' ')
+            self.getMsg(' ')
+            self.getMsg(' ')
+            self.assertResponses('repolog test2 feature', expected)
+        finally:
+            conf.supybot.plugins.Git.maxOpenRepos.setValue(32)
+
+    def testOdbBackend(self):
+        option = conf.supybot.plugins.Git.repos.test2.odbBackend
+        self.assertError('config plugins.Git.repos.test2.odbBackend foo')
+        option.setValue('cmd')
+        repository = self.irc.getCallback('Git').repos.get()[1]
+        self.assertTrue(isinstance(repository.repo.odb, git.GitCmdObjectDB))
+        repository.recent.clear()
+        self.assertResponse('repolog test2 feature',
+                            '[test2|feature|Tyrion Lannister] '
+                                'Snarks and grumpkins')
+
+    def testFormatChange(self):
+        option = conf.supybot.plugins.Git.repos.test2.commitMessage1
+        option.setValue('(%n) %m')
+        expected = ['(test2) Snarks and grumpkins']
+        self.assertResponses('repolog test2 feature', expected)
+
+    def testChannelsChange(self):
+        option = conf.supybot.plugins.Git.repos.test2.channels
+        option.setValue(['#other'])
+        expected = ['Sorry, not allowed in this channel.']
+        self.assertResponses('repolog test2 feature', expected)
+        self.assertResponses('What about cbe46d8?', [],
+                             usePrefixChar=False)
+
+    def testSnarfMany(self):
+        expected = [
+            "Talking about cbe46d8?",
+            "I. e., [test2|Tyrion Lannister]"
+                " I am the only one getting things done",
+            "Talking about f271e28?",
+            "I. e., [test2|Tyrion Lannister] Snarks and grumpkins",
+        ]
+        self.assertResponses('cbe46d8, deadbeef and f271e28 cbe46d8',
+                             expected, usePrefixChar=False)
+
+    def testSnarfRejected(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        iter_log = plugin._iter_log
+
+        def rejecting(repo, *args):
+            if 'deadbeef^{commit}' in args:
+                raise git.GitCommandError(['git', 'log'], 128, 'ambiguous')
+            return iter_log(repo, *args)
+
+        plugin._iter_log = rejecting
+        try:
+            expected = [
+                "Talking about f271e28?",
+                "I. e., [test2|Tyrion Lannister] Snarks and grumpkins",
+            ]
+            self.assertResponses('deadbeef or f271e28', expected,
+                                 usePrefixChar=False)
+        finally:
+            plugin._iter_log = iter_log
+
+    def testSnarfRepeated(self):
+        expected = [
+            "Talking about cbe46d8?",
+            "I. e., [test2|Tyrion Lannister]"
+                " I am the only one getting things done",
+        ]
+        self.assertResponses('What about cbe46d8?', expected,
+                             usePrefixChar=False)
+        self.assertResponses('Really, cbe46d823207?', [],
+                             usePrefixChar=False)
+        conf.supybot.plugins.Git.snarfDedupWindow.setValue(0)
+        try:
+            self.assertResponses('What about cbe46d8?', expected,
+                                 usePrefixChar=False)
+        finally:
+            conf.supybot.plugins.Git.snarfDedupWindow.setValue(600)
+
+    def testSnarfDisabled(self):
+        conf.supybot.plugins.Git.repos.test2.enableSnarf.setValue(False)
+        expected = ['Git reinitialized with 2 repositories.',
+                    'The operation succeeded.'
+        ]
+        self.assertResponses('reload Git', expected)
+        self.assertResponses('What about cbe46d8?', [],
+                             usePrefixChar=False)
+
+
+class GitCatalogTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
+    channel = '#test'
+    plugins = ('Git',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.maxCommitsAtOnce.setValue(3)
+        self.clear_repos()
+        self.assertNotError(
+            'repoadd test2 plugins/Git/test-data/git-repo #test')
+        self.getMsg(' ')
+        conf.supybot.plugins.Git.repos.test2.commitCatalog.setValue(True)
+        expected = ['Git reinitialized with 1 repository.',
+                    'The operation succeeded.'
+        ]
+        self.assertResponses('reload Git', expected)
+        self.repository = self.irc.getCallback('Git').repos.get()[0]
+
+    def testCatalogContents(self):
+        commits = self.repository.catalog.recent('master', 10)
+        repo = git.Repo(os.path.join(DATA_DIR, 'git-repo'))
+        expected = [c.hexsha for c in repo.iter_commits('master')]
+        self.assertEqual([c.hexsha for c in commits], expected)
+        found = self.repository.catalog.lookup(['cbe46d8', '0000000'])
+        self.assertEqual(found.keys(), ['cbe46d8'])
+        self.assertEqual(found['cbe46d8'].subject,
+                         'I am the only one getting things done')
+
+    def testLogFive(self):
+        expected = [
+            'Showing latest 3 of 5 commits to test2...',
+            '[test2|feature|Tyrion Lannister] I am more long-winded',
+            '[test2|feature|Tyrion Lannister] Snarks and grumpkins',
+            '[test2|feature|Ned Stark] Fix bugs.',
+        ]
+        self.assertResponses('repolog test2 feature 5', expected)
+
+    def testSnarf(self):
+        expected = [
+            "Talking about cbe46d8?",
+            "I. e., [test2|Tyrion Lannister]"
+                " I am the only one getting things done",
+        ]
+        self.assertResponses('What about cbe46d8?', expected,
+                             usePrefixChar=False)
+
+
+class GitSearchTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
+    channel = '#test'
+    plugins = ('Git',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.maxCommitsAtOnce.setValue(3)
+        self.clear_repos()
+        self.assertNotError(
+            'repoadd test1 plugins/Git/test-data/git-repo #test')
+        self.getMsg(' ')
+        self.assertNotError(
+            'repoadd test2 plugins/Git/test-data/git-repo #test')
+        self.getMsg(' ')
+        conf.supybot.plugins.Git.repos.test2.commitCatalog.setValue(True)
+        expected = ['Git reinitialized with 2 repositories.',
+                    'The operation succeeded.'
+        ]
+        self.assertResponses('reload Git', expected)
+
+    def testSearchNoCatalog(self):
+        expected = ['Search requires the commitCatalog option for test1']
+        self.assertResponses('gitsearch test1 bugs', expected)
+
+    def testSearchWord(self):
+        expected = ['[test2|feature|Tyrion Lannister] Snarks and grumpkins']
+        self.assertResponses('gitsearch test2 Grumpkins', expected)
+
+    def testSearchAuthor(self):
+        expected = ['[test2|feature|Ned Stark] Fix bugs.']
+        self.assertResponses('gitsearch test2 author:stark fix', expected)
+
+    def testSearchLimited(self):
+        expected = [
+            'Showing latest 3 of 7 matches in test2...',
+            '[test2|master|tlannister] Stupid commit 7',
+            '[test2|master|tlannister] Stupid commit 6',
+            '[test2|master|Ned Stark] Stupid commit 5',
+        ]
+        self.assertResponses('gitsearch test2 stupid commit', expected)
+
+    def testSearchNoMatch(self):
+        expected = ['No matching commits']
+        self.assertResponses('gitsearch test2 stupid until:2001-01-01',
+                             expected)
+
 
 class GitKillTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#test'
@@ -304,14 +522,76 @@ class GitKillTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponses('reload Git', expected)
 
     def testKill(self):
+        path = os.path.join(conf.supybot.plugins.Git.repoDir(), 'test2')
+        self.assertTrue(os.path.exists(path))
         expected = "Repository deleted"
         self.assertResponse('repokill test2', expected)
+        self.assertFalse(os.path.exists(path))
         expected = ['Git reinitialized with 1 repository.',
                     'The operation succeeded.'
         ]
         self.assertResponses('reload Git', expected)
 
 
+class GitImportTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
+    channel = '#test'
+    plugins = ('Git',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        self.clear_repos()
+        fd, self.manifest = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        self.clear_repos()
+        os.unlink(self.manifest)
+        ChannelPluginTestCase.tearDown(self)
+
+    def writeManifest(self, *lines):
+        with open(self.manifest, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def testImport(self):
+        self.writeManifest('# name url channels',
+                           '',
+                           'test1 plugins/Git/test-data/git-repo #test',
+                           'test2 plugins/Git/test-data/git-repo #test,#foo',
+                           'test3 plugins/Git/test-data/no-such-repo #test')
+        self.assertResponse('repoimport ' + self.manifest,
+                            'Cloning 3 repositories...')
+        replies = [self.getMsg(' ').args[1] for i in range(3)]
+        self.assertEqual(replies[-1], 'Import done: 2 of 3 repositories'
+                                      ' cloned, failed: test3')
+        self.assertResponse('repolist', '\x02test1\x02  '
+                            'plugins/Git/test-data/git-repo 4 branches')
+        self.getMsg(' ')
+
+    def testImportCloning(self):
+        callback = self.irc.getCallback('Git')
+        self.assertTrue(callback._reserve_clone('test1'))
+        try:
+            self.assertResponse(
+                'repoadd test1 plugins/Git/test-data/git-repo #test',
+                'Error: test1 is already being cloned')
+            self.writeManifest('test1 plugins/Git/test-data/git-repo #test')
+            self.assertResponse('repoimport ' + self.manifest,
+                                'Skipping repo being cloned test1')
+            self.assertResponse(' ', 'Nothing to import')
+        finally:
+            callback._cloning.discard('test1')
+
+    def testImportBadLine(self):
+        self.writeManifest('test1 plugins/Git/test-data/git-repo',
+                           'test2 plugins/Git/test-data/git-repo #test')
+        self.assertResponse('repoimport ' + self.manifest,
+                            'Error: Bad manifest line 1: '
+                            'test1 plugins/Git/test-data/git-repo')
+        self.assertResponse('repolist',
+                            'No repositories configured for this channel.')
+
+
 class GitBranchTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#test'
     plugins = ('Git',)
@@ -346,5 +626,640 @@ class GitBranchTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponse('repostat test2', expected)
 
 
+class UpstreamMixin(object):
+    "Tests using a private upstream repository which can be modified."
+
+    def setUpUpstream(self):
+        "Clone test data to a modifiable upstream, add it as test1."
+        self.upstream = tempfile.mkdtemp()
+        git.Git('.').clone(os.path.join(DATA_DIR, 'git-repo'), self.upstream)
+        self.assertNotError('repoadd test1 %s #test' % self.upstream)
+        self.getMsg(' ')
+
+    def tearDownUpstream(self):
+        self.clear_repos()
+        shutil.rmtree(self.upstream)
+
+    def fetch(self):
+        "Run a fetch like the periodic fetcher does."
+        for repository in self.irc.getCallback('Git').repos.get():
+            with repository.lock:
+                repository.fetch()
+
+    def assertPoll(self, expected):
+        "Run repopoll test1, assert replies besides the timing line."
+        # Fetching takes time, wait longer than usual for replies.
+        msgs = self._feedMsgLoop('repopoll test1', timeout_=1)
+        responses = [m.args[1] for m in msgs]
+        timing = [r for r in responses
+                      if re.match(r'Fetched test1 in [\d.]+ s, polled in'
+                                  r' [\d.]+ s$', r)]
+        self.assertEqual(len(timing), 1, '\n'.join(responses))
+        responses.remove(timing[0])
+        self.assertEqual(sorted(responses), sorted(expected))
+
+    def commit(self, message, branch='master', path=None):
+        "Add a commit by Arya Stark to upstream branch, creating path."
+        upstream = git.Repo(self.upstream)
+        upstream.git.checkout(branch)
+        if path:
+            path = os.path.join(self.upstream, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+            upstream.git.add(path)
+        upstream.git.execute(['git',
+                              '-c', 'user.name=Arya Stark',
+                              '-c', 'user.email=arya@winterfell',
+                              'commit', '--allow-empty', '-m', message])
+
+    def merge(self, branch, into='master'):
+        "Merge upstream branch into another with a merge commit."
+        upstream = git.Repo(self.upstream)
+        upstream.git.checkout(into)
+        upstream.git.execute(['git',
+                              '-c', 'user.name=Arya Stark',
+                              '-c', 'user.email=arya@winterfell',
+                              'merge', '--no-ff', '-m',
+                              'Merge branch %s' % branch, branch])
+
+
+class GitBranchDiscoveryTest(ChannelPluginTestCase, PluginTestCaseUtilMixin,
+                             UpstreamMixin):
+    channel = '#test'
+    plugins = ('Git',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        self.clear_repos()
+        self.setUpUpstream()
+
+    def tearDown(self):
+        self.tearDownUpstream()
+        ChannelPluginTestCase.tearDown(self)
+
+    def testNewBranch(self):
+        self.assertResponse('repostat test1', 'Watched branches: master')
+        git.Repo(self.upstream).git.branch('release1', 'master')
+        self.fetch()
+        reply = self.getMsg('repostat test1').args[1]
+        self.assertEqual(sorted(reply.split(': ', 1)[1].split(', ')),
+                         ['master', 'release1'])
+
+    def testNewBranchRetried(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+
+        def failing(branch):
+            raise git.GitCommandError(['git', 'fetch'], 1, 'failed')
+
+        git.Repo(self.upstream).git.branch('release1', 'master')
+        repository._track_branch = failing
+        try:
+            self.assertRaises(git.GitCommandError, self.fetch)
+        finally:
+            del repository._track_branch
+        self.fetch()
+        self.assertTrue('release1' in repository.branches)
+
+    def testNewBranchAnnounced(self):
+        conf.supybot.plugins.Git.repos.test1.announceBranches.setValue(True)
+        git.Repo(self.upstream).git.branch('release1', 'master')
+        self.fetch()
+        self.assertPoll(['Branch release1 created at test1'])
+
+    def testBranchEventsNotQueued(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        git.Repo(self.upstream).git.branch('release1', 'master')
+        self.fetch()
+        self.assertEqual(repository.branch_events, [])
+
+    def testEventsDroppedWhenSkipped(self):
+        option = conf.supybot.plugins.Git.repos.test1
+        option.announceBranches.setValue(True)
+        option.channels.setValue(['#unavailable'])
+        callback = self.irc.getCallback('Git')
+        plugin = sys.modules[callback.__module__]
+        repository = callback.repos.get()[0]
+        git.Repo(self.upstream).git.branch('release1', 'master')
+        self.fetch()
+        self.assertEqual(repository.branch_events, [('created', 'release1')])
+        plugin._poll_all_repos(callback.repos, throw=True)
+        self.assertEqual(repository.branch_events, [])
+        self.assertEqual(repository.tag_events, [])
+
+    def testBranchesChange(self):
+        git.Repo(self.upstream).git.branch('release1', 'master')
+        conf.supybot.plugins.Git.repos.test1.branches.setValue('rel*')
+        self.fetch()
+        self.assertResponse('repostat test1', 'Watched branches: release1')
+
+    def testBranchesChangeRetried(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+
+        def failing():
+            raise git.GitCommandError(['git', 'fetch'], 1, 'failed')
+
+        git.Repo(self.upstream).git.branch('release1', 'master')
+        conf.supybot.plugins.Git.repos.test1.branches.setValue('rel*')
+        repository._fetch_remote = failing
+        try:
+            self.assertRaises(git.GitCommandError, self.fetch)
+        finally:
+            del repository._fetch_remote
+        self.fetch()
+        self.assertResponse('repostat test1', 'Watched branches: release1')
+
+    def testRefFilter(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        matcher = plugin._BranchMatcher('master rel* release-[0-9]*')
+        self.assertEqual(matcher.prefixes(), ['master', 'rel'])
+        self.assertEqual(plugin._BranchMatcher('rel* *').prefixes(), [''])
+        conf.supybot.plugins.Git.repos.test1.branches.setValue('master')
+        self.fetch()
+        upstream = git.Repo(self.upstream)
+        upstream.git.branch('feature2', 'master')
+        upstream.git.update_ref('refs/pull/1/head', 'master')
+        self.fetch()
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        refs = repository.repo.git.for_each_ref('--format=%(refname)')
+        self.assertFalse('feature2' in refs or 'pull' in refs, refs)
+
+    def testMaintain(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        repository.maintain()
+        path = os.path.join(repository.repo.git_dir,
+                            'objects', 'info', 'commit-graphs')
+        self.assertTrue(os.listdir(path))
+        self.assertResponse('repostat test1', 'Watched branches: master')
+        self.assertRegexp(' ', r'Maintained .*, rev walk [\d.]+ ms before,'
+                               r' [\d.]+ ms after')
+
+    def testMaintainBusy(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        repository._fetching = threading.Event()
+        try:
+            self.assertFalse(repository.maintain())
+        finally:
+            repository._fetching = None
+        started = threading.Event()
+        release = threading.Event()
+
+        def maintain():
+            started.set()
+            release.wait()
+
+        repository._maintain = maintain
+        try:
+            thread = threading.Thread(target=repository.maintain)
+            thread.start()
+            started.wait()
+            self.assertTrue(repository.maintaining)
+            fetcher = threading.Thread(target=repository.fetch_once)
+            fetcher.start()
+            fetcher.join(0.5)
+            self.assertTrue(fetcher.isAlive())
+            release.set()
+            thread.join()
+            fetcher.join()
+        finally:
+            release.set()
+            del repository._maintain
+        self.assertFalse(repository.maintaining)
+
+    def testMaintainFailed(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        repository._LOW_PRIORITY = ['false']
+        try:
+            self.assertRaises(git.GitCommandError, repository.maintain)
+        finally:
+            del repository._LOW_PRIORITY
+        self.assertEqual(repository.maintained[1:], (None, None))
+        self.assertResponse('repostat test1', 'Watched branches: master')
+        self.assertRegexp(' ', r'Maintenance failed ')
+
+
+class GitPollTest(ChannelPluginTestCase, PluginTestCaseUtilMixin,
+                  UpstreamMixin):
+    channel = '#test'
+    plugins = ('Git',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.maxCommitsAtOnce.setValue(3)
+        self.clear_repos()
+        self.setUpUpstream()
+
+    def tearDown(self):
+        self.tearDownUpstream()
+        ChannelPluginTestCase.tearDown(self)
+
+    def testPollNothing(self):
+        self.assertPoll([])
+
+    def testPollOne(self):
+        self.commit('Winter is coming')
+        expected = ['Arya Stark pushed 1 commit(s) to master at test1',
+                    '[test1|master|Arya Stark] Winter is coming']
+        self.assertPoll(expected)
+        self.assertPoll([])
+
+    def testRecentBuffer(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        head, buf = repository.recent['master']
+        self.assertEqual(head, repository.commit_by_branch['master'])
+        self.commit('Winter is coming')
+        self.assertPoll(['Arya Stark pushed 1 commit(s) to master at test1',
+                         '[test1|master|Arya Stark] Winter is coming'])
+        head, buf = repository.recent['master']
+        self.assertEqual(buf[0].subject, 'Winter is coming')
+        self.assertEqual(buf[0].hexsha, head)
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        iter_log = plugin._iter_log
+        plugin._iter_log = None
+        try:
+            self.assertResponse('repolog test1 master 2',
+                                '[test1|master|Arya Stark] Winter is coming')
+            self.assertRegexp(' ', r'\[test1\|master\|Tyrion Lannister\]')
+        finally:
+            plugin._iter_log = iter_log
+
+    def testMergeCatalog(self):
+        option = conf.supybot.plugins.Git.repos.test1
+        option.commitCatalog.setValue(True)
+        option.branches.setValue('master topic')
+        upstream = git.Repo(self.upstream)
+        upstream.git.branch('topic', 'master')
+        self.commit('Winter is coming', branch='topic')
+        self.fetch()
+        self.commit('The north remembers')
+        self.merge('topic')
+        self.fetch()
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        with repository.lock:
+            repository.get_new_commits()
+        commits = repository.catalog.recent('master', 4)
+        expected = [c.hexsha for c in upstream.iter_commits('master',
+                                                            max_count=4)]
+        self.assertEqual([c.hexsha for c in commits], expected)
+
+    def testMergeRecent(self):
+        conf.supybot.plugins.Git.repos.test1.branches.setValue('master topic')
+        upstream = git.Repo(self.upstream)
+        upstream.git.branch('topic', 'master')
+        self.commit('Winter is coming', branch='topic')
+        self.fetch()
+        self.commit('The north remembers')
+        self.merge('topic')
+        self.fetch()
+        callback = self.irc.getCallback('Git')
+        plugin = sys.modules[callback.__module__]
+        plugin._poll_all_repos(callback.repos, throw=True)
+        while self.irc.takeMsg():
+            pass
+        repository = callback.repos.get()[0]
+        commits = repository.get_recent_commits('master', 4)
+        expected = [c.hexsha for c in upstream.iter_commits('master',
+                                                            max_count=4)]
+        self.assertEqual([c.hexsha for c in commits], expected)
+
+    def testMultiTarget(self):
+        for channel in ['#other', '#third']:
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+            self.irc.takeMsg()
+            self.irc.takeMsg()
+        conf.supybot.plugins.Git.repos.test1.channels.setValue(
+            ['#test', '#other', '#third'])
+        self.irc.state.supported['targmax'] = 'NAMES:1,PRIVMSG:2,NOTICE:2'
+        self.commit('Winter is coming')
+        # The test framework can't reply to multi-target messages.
+        self.fetch()
+        callback = self.irc.getCallback('Git')
+        plugin = sys.modules[callback.__module__]
+        plugin._poll_all_repos(callback.repos, throw=True)
+        msgs = []
+        msg = self.irc.takeMsg()
+        while msg:
+            msgs.append(msg)
+            msg = self.irc.takeMsg()
+        targets = [m.args[0] for m in msgs
+                       if m.args[1].endswith('Winter is coming')]
+        self.assertEqual(len(targets), 2, targets)
+        self.assertTrue(all([len(t.split(',')) <= 2 for t in targets]))
+        self.assertEqual(sorted(','.join(targets).split(',')),
+                         ['#other', '#test', '#third'])
+
+    def testFilters(self):
+        option = conf.supybot.plugins.Git.repos.test1
+        try:
+            option.paths.get('#test').setValue(['src'])
+            self.commit('Winter is coming')
+            self.commit('Hold the door', path='src/hodor')
+            expected = ['Arya Stark pushed 1 commit(s) to master at test1',
+                        '[test1|master|Arya Stark] Hold the door']
+            self.assertPoll(expected)
+            option.authors.get('#test').setValue(['TYRION'])
+            self.commit('Valar morghulis', path='src/faceless')
+            self.assertPoll([])
+        finally:
+            option.paths.get('#test').setValue([])
+            option.authors.get('#test').setValue([])
+
+    def testTags(self):
+        conf.supybot.plugins.Git.repos.test1.trackTags.setValue(True)
+        self.assertPoll([])
+        self.commit('Winter is coming')
+        upstream = git.Repo(self.upstream)
+        upstream.git.tag('light')
+        upstream.git.execute(['git',
+                              '-c', 'user.name=Arya Stark',
+                              '-c', 'user.email=arya@winterfell',
+                              'tag', '-a', '-m', 'Release 1.0', 'v1.0'])
+        expected = ['Tag light created at test1: Winter is coming',
+                    'Tag v1.0 created at test1: Release 1.0',
+                    'Arya Stark pushed 1 commit(s) to master at test1',
+                    '[test1|master|Arya Stark] Winter is coming']
+        self.assertPoll(expected)
+        upstream.git.tag('-d', 'v1.0')
+        self.assertPoll(['Tag v1.0 deleted at test1'])
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        self.assertEqual(repository.tags_at(upstream.head.commit.hexsha),
+                         ['light'])
+
+    def testDiffstat(self):
+        option = conf.supybot.plugins.Git.repos.test1.commitMessage1
+        option.setValue('[%n|%a] %m (%f files, +%+/-%-, 100%%-ish)')
+        self.commit('Hold the door', path='src/hodor')
+        self.fetch()
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        head = git.Repo(self.upstream).head.commit.hexsha
+        self.assertEqual(repository._diffstats.get(head), (1, 0, 0))
+        expected = ['Arya Stark pushed 1 commit(s) to master at test1',
+                    '[test1|Arya Stark] Hold the door (1 files, +0/-0,'
+                        ' 100%-ish)']
+        self.assertPoll(expected)
+
+    def testCatchUp(self):
+        conf.supybot.plugins.Git.catchUpThreshold.setValue(2)
+        try:
+            self.commit('Winter is coming')
+            self.commit('Hold the door')
+            self.commit('Valar morghulis')
+            expected = ['Catching up: 3 commit(s) to master at test1 by'
+                            ' Arya Stark (3)',
+                        '[test1|master|Arya Stark] Winter is coming',
+                        '[test1|master|Arya Stark] Valar morghulis']
+            self.assertPoll(expected)
+            self.commit('Not today')
+            self.assertPoll(
+                ['Arya Stark pushed 1 commit(s) to master at test1',
+                 '[test1|master|Arya Stark] Not today'])
+        finally:
+            conf.supybot.plugins.Git.catchUpThreshold.setValue(50)
+
+    def testCatchUpCatalog(self):
+        conf.supybot.plugins.Git.repos.test1.commitCatalog.setValue(True)
+        conf.supybot.plugins.Git.catchUpThreshold.setValue(2)
+        try:
+            self.fetch()
+            self.commit('Winter is coming')
+            self.commit('Hold the door')
+            self.commit('Valar morghulis')
+            self.assertPoll(['Catching up: 3 commit(s) to master at test1 by'
+                                 ' Arya Stark (3)',
+                             '[test1|master|Arya Stark] Winter is coming',
+                             '[test1|master|Arya Stark] Valar morghulis'])
+            repository = self.irc.getCallback('Git').repos.get()[0]
+            self.assertEqual(repository.catalog.recent('master', 1)[0].subject,
+                             'I am the only one getting things done')
+            self.fetch()
+            self.commit('Not today')
+            self.assertPoll(
+                ['Arya Stark pushed 1 commit(s) to master at test1',
+                 '[test1|master|Arya Stark] Not today'])
+            upstream = git.Repo(self.upstream)
+            expected = [c.hexsha for c in upstream.iter_commits('master',
+                                                                max_count=5)]
+            commits = repository.catalog.recent('master', 5)
+            self.assertEqual([c.hexsha for c in commits], expected)
+        finally:
+            conf.supybot.plugins.Git.catchUpThreshold.setValue(50)
+
+    def testPollAll(self):
+        self.commit('Winter is coming')
+        self.assertResponses('repopoll', ['The operation succeeded.'])
+        self.fetch()
+        expected = ['Arya Stark pushed 1 commit(s) to master at test1',
+                    '[test1|master|Arya Stark] Winter is coming',
+                    'The operation succeeded.']
+        self.assertResponses('repopoll', expected)
+
+    def testAdaptiveInterval(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        repos = self.irc.getCallback('Git').repos
+        repository = repos.get()[0]
+        fetcher = plugin._GitFetcher(repos, lambda *args: None)
+        conf.supybot.plugins.Git.pollPeriod.setValue(100)
+        try:
+            fetcher._sync({'test1': repository})
+            self.assertEqual(fetcher.due('test1')[1], 100)
+            fetcher._fetch(repository)
+            self.assertEqual(fetcher.due('test1')[1], 150)
+            self.commit('Winter is coming')
+            fetcher._fetch(repository)
+            self.assertEqual(fetcher.due('test1')[1], 75)
+            fetcher._fetch(repository)
+            fetcher._sync({})
+            self.assertEqual(fetcher.due('test1'), None)
+        finally:
+            conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        self.assertEqual(plugin._next_interval(40, True, 30, 900), 30)
+        self.assertEqual(plugin._next_interval(800, False, 30, 900), 900)
+        self.assertEqual(plugin._next_interval(1, True, 0, 900), 1)
+
+    def testBreaker(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        repos = self.irc.getCallback('Git').repos
+        repository = repos.get()[0]
+        fetcher = plugin._GitFetcher(repos, lambda *args: None)
+        fetcher._sync({'test1': repository})
+        bad_url = self.upstream + '-gone'
+        conf.supybot.plugins.Git.repos.test1.url.setValue(bad_url)
+        for i in range(3):
+            fetcher._fetch(repository)
+        self.assertResponse('repostat test1', 'Watched branches: master')
+        self.assertRegexp(' ', r'Fetch: repo test1 open after 3 failure\(s\),'
+                               r' retry in \d+ s')
+        self.assertFalse(plugin._BREAKERS.allow(repository))
+        conf.supybot.plugins.Git.repos.test1.url.setValue(self.upstream)
+        plugin._BREAKERS._get(repository)[0].retry_at = 0
+        fetcher._fetch(repository)
+        self.assertEqual(plugin._BREAKERS.troubles(repository), [])
+
+    def testFetchCrash(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        repos = self.irc.getCallback('Git').repos
+        repository = repos.get()[0]
+        fetcher = plugin._GitFetcher(repos, lambda *args: None)
+        fetcher._sync({'test1': repository})
+
+        def crash():
+            raise ValueError('crash')
+
+        repository.fetch = crash
+        try:
+            for i in range(3):
+                fetcher._fetch(repository)
+        finally:
+            del repository.fetch
+        self.assertTrue(fetcher.due('test1'))
+        breaker = plugin._BREAKERS._get(repository)[0]
+        self.assertEqual(breaker.failures, 3)
+        breaker.retry_at = 0
+        fetcher._fetch(repository)
+        self.assertEqual(plugin._BREAKERS.troubles(repository), [])
+
+    def testMemory(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        conf.supybot.plugins.Git.memorySampleRate.setValue(1.0)
+        try:
+            plugin._MEMORY.begin('test1')
+            repository.fetch_once()
+            self.irc.getCallback('Git')._fetch_done([repository])
+        finally:
+            conf.supybot.plugins.Git.memorySampleRate.setValue(0.0)
+        self.assertRegexp('gitmem', r'RSS: \d+ kB, \+\d+ kB during')
+        self.assertRegexp(' ', r'Growth in last sampled cycle \(test1\)')
+        self.assertRegexp(' ', r'Retained objects: test1 \d+')
+
+    def testTrace(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        tracer = plugin._TRACER
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        path = os.path.join(self.upstream, 'trace.json')
+        conf.supybot.plugins.Git.traceFile.setValue(path)
+        try:
+            self.commit('Winter is coming')
+            trace = tracer.begin('test1')
+            with tracer.activate(trace):
+                with tracer.span('repo fetch'):
+                    repository.fetch_once()
+            trace['queued'] = time.time()
+            self.irc.getCallback('Git')._fetch_done([repository], trace)
+        finally:
+            conf.supybot.plugins.Git.traceFile.setValue('')
+            tracer._get_logger()
+        expected = ['Arya Stark pushed 1 commit(s) to master at test1',
+                    '[test1|master|Arya Stark] Winter is coming']
+        self.assertResponses(' ', expected)
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(sorted(set([s['name'] for s in spans])),
+                         ['cycle', 'lock wait', 'queue', 'ref update',
+                          'render', 'repo fetch', 'rev count', 'rev walk'])
+        self.assertEqual(set([s['trace'] for s in spans]),
+                         set([trace['trace']]))
+        walk = [s for s in spans if s['name'] == 'rev walk'][0]
+        self.assertEqual(walk['commits'], 1)
+
+    def testPollShared(self):
+        upstream = git.Repo(self.upstream)
+        upstream.git.branch('release1', 'master')
+        self.assertPoll([])
+        self.commit('Winter is coming')
+        upstream.git.branch('-f', 'release1', 'master')
+        expected = [
+            'Arya Stark pushed 1 commit(s) to master,release1 at test1',
+            '[test1|master,release1|Arya Stark] Winter is coming']
+        self.assertPoll(expected)
+
+
+# Holds the lock file given as argument until stdin is closed.
+LOCKER = '''
+import fcntl, sys
+f = open(sys.argv[1], 'a')
+fcntl.flock(f, fcntl.LOCK_EX)
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sys.stdin.read()
+'''
+
+
+class GitSharedTest(ChannelPluginTestCase, PluginTestCaseUtilMixin,
+                    UpstreamMixin):
+    channel = '#test'
+    plugins = ('Git',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.sharedMode.setValue(True)
+        self.clear_repos()
+        self.path = os.path.join(conf.supybot.plugins.Git.repoDir(), 'test1')
+        shutil.rmtree(self.path, True)
+        for path in [self.path + '.lock', self.path + '.state.json']:
+            if os.path.exists(path):
+                os.unlink(path)
+        self.setUpUpstream()
+        self.repository = self.irc.getCallback('Git').repos.get()[0]
+
+    def tearDown(self):
+        self.tearDownUpstream()
+        conf.supybot.plugins.Git.sharedMode.setValue(False)
+        ChannelPluginTestCase.tearDown(self)
+
+    def testFollower(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        follower = plugin._Repository('test1')
+        self.assertTrue(follower.following)
+        self.assertEqual(follower.commit_by_branch,
+                         self.repository.commit_by_branch)
+        self.commit('Winter is coming')
+        self.assertFalse(follower.fetch())
+        self.assertEqual(follower.get_new_commits(), {})
+        self.repository.fetch_once()
+        self.assertTrue(follower.fetch())
+        commits = follower.get_new_commits()['master']
+        self.assertEqual([c.subject for c in commits], ['Winter is coming'])
+        state = json.load(open(self.path + '.state.json'))
+        self.assertEqual(state['tips'], follower.new_heads)
+
+    def testFollowerTakesOver(self):
+        plugin = sys.modules[self.irc.getCallback('Git').__module__]
+        follower = plugin._Repository('test1')
+        self.assertTrue(follower.following)
+        self.repository.shared.release()
+        try:
+            self.commit('Winter is coming')
+            self.assertTrue(follower.fetch())
+            self.assertFalse(follower.following)
+            self.assertEqual(follower.branch_events, [])
+            commits = follower.get_new_commits()['master']
+            self.assertEqual([c.subject for c in commits],
+                             ['Winter is coming'])
+        finally:
+            follower.shared.release()
+
+    def testFailover(self):
+        self.repository.shared.release()
+        other = subprocess.Popen([sys.executable, '-c', LOCKER,
+                                  self.path + '.lock'],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(other.stdout.readline(), 'locked\n')
+            self.commit('Winter is coming')
+            self.assertPoll([])
+            self.assertTrue(self.repository.following)
+        finally:
+            other.stdin.close()
+            other.wait()
+        expected = ['Arya Stark pushed 1 commit(s) to master at test1',
+                    '[test1|master|Arya Stark] Winter is coming']
+        self.assertPoll(expected)
+        self.assertFalse(self.repository.following)
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: